@@ -0,0 +1,96 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import time
+from database import migrated_connection
+
+
+CATALOG_PATH = os.getenv('CATALOG_CSV', '/data/catalog.csv')
+CATALOG_IMPORT_CHUNK = int(os.getenv('CATALOG_IMPORT_CHUNK', '10000'))
+
+# Catalog columns filled from the CSV; processed_dir_name and final_symlink_path belong to the symlinker
+IMPORT_COLUMNS = ['eid', 'title', 'type', 'year', 'parent_eid', 'parent_title', 'parent_type', 'parent_year',
+                  'grandparent_eid', 'grandparent_title', 'grandparent_type', 'grandparent_year',
+                  'torrent_file_name', 'actual_title']
+
+
+def row_hash(values):
+    return hashlib.sha1(json.dumps(values).encode('utf-8')).hexdigest()
+
+
+# Columns are matched by header name; missing ones import as NULL
+def read_catalog_csv(csv_path, chunk_size=CATALOG_IMPORT_CHUNK):
+    with open(csv_path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.DictReader(f)
+        missing = [column for column in IMPORT_COLUMNS if column not in (reader.fieldnames or [])]
+        if 'eid' in missing:
+            raise ValueError(f"{csv_path} has no eid column")
+        if missing:
+            print(f"Columns missing from {csv_path}, importing them as empty: {', '.join(missing)}")
+        chunk = []
+        for record in reader:
+            values = [(record.get(column) or '').strip() or None for column in IMPORT_COLUMNS]
+            if not values[0]:
+                continue
+            chunk.append((values[0], values, row_hash(values)))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+# Upserts by eid; the stored import hash lets a re-import skip unchanged rows.
+# A running monitor sees new rows on its next pass, rows changed in place on its next full catalog scan.
+def import_catalog(csv_path=CATALOG_PATH, chunk_size=CATALOG_IMPORT_CHUNK):
+    started = time.monotonic()
+    conn = migrated_connection()
+    inserted = updated = unchanged = 0
+    assignments = ', '.join(f'{column} = ?' for column in IMPORT_COLUMNS)
+    placeholders = ', '.join('?' for _ in IMPORT_COLUMNS)
+
+    for chunk in read_catalog_csv(csv_path, chunk_size):
+        # Later rows for the same eid win, as they would row by row
+        latest = {eid: (values, digest) for eid, values, digest in chunk}
+        existing = {}
+        eids = list(latest)
+        for start in range(0, len(eids), 500):
+            batch = eids[start:start + 500]
+            rows = conn.execute(f'''
+                SELECT id, eid, import_hash FROM catalog WHERE eid IN ({', '.join('?' for _ in batch)})
+            ''', batch).fetchall()
+            for row in rows:
+                existing.setdefault(row['eid'], []).append((row['id'], row['import_hash']))
+
+        inserts = []
+        updates = []
+        for eid, (values, digest) in latest.items():
+            if eid not in existing:
+                inserts.append((*values, digest))
+                continue
+            for id, current_hash in existing[eid]:
+                if current_hash == digest:
+                    unchanged += 1
+                else:
+                    updates.append((*values, digest, id))
+
+        with conn:
+            conn.executemany(f'''
+                INSERT INTO catalog ({', '.join(IMPORT_COLUMNS)}, import_hash) VALUES ({placeholders}, ?)
+            ''', inserts)
+            conn.executemany(f'UPDATE catalog SET {assignments}, import_hash = ? WHERE id = ?', updates)
+        inserted += len(inserts)
+        updated += len(updates)
+
+    print(f"Imported {csv_path} in {time.monotonic() - started:.1f}s: {inserted} new, {updated} changed, "
+          f"{unchanged} unchanged")
+    return inserted, updated, unchanged
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load a plex_debrid catalog.csv into the media database.')
+    parser.add_argument('csv_path', nargs='?', default=CATALOG_PATH, help=f'Catalog CSV to import (default {CATALOG_PATH}).')
+    args = parser.parse_args()
+    import_catalog(args.csv_path)
@@ -0,0 +1,151 @@
+import os
+import sqlite3
+import threading
+
+
+DATABASE_PATH = '/data/media_database.db'
+SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', '30'))
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_CACHE_SIZE = int(os.getenv('SQLITE_CACHE_SIZE', str(-64 * 1024)))  # negative values are KiB
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+SQLITE_CACHED_STATEMENTS = int(os.getenv('SQLITE_CACHED_STATEMENTS', '256'))
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schemas_ready = set()
+_read_only = False
+
+
+def set_read_only(read_only=True):
+    # Dry runs open the database read-only and leave the schema alone
+    global _read_only
+    _read_only = read_only
+
+
+def is_read_only():
+    return _read_only
+
+
+def configure_connection(conn):
+    # WAL lets the UI read while the monitor writes; NORMAL is durable under WAL except on power loss
+    if not _read_only:
+        conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute(f'PRAGMA synchronous = {SQLITE_SYNCHRONOUS}')
+    conn.execute(f'PRAGMA cache_size = {SQLITE_CACHE_SIZE}')
+    conn.execute(f'PRAGMA mmap_size = {SQLITE_MMAP_SIZE}')
+    conn.execute(f'PRAGMA busy_timeout = {int(SQLITE_BUSY_TIMEOUT * 1000)}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+
+
+# One long-lived connection per thread and path; commit with `with conn:` instead of closing it
+def get_connection(path=None):
+    path = path or DATABASE_PATH
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get((path, _read_only))
+    if conn is None:
+        if _read_only:
+            conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=SQLITE_BUSY_TIMEOUT,
+                                   cached_statements=SQLITE_CACHED_STATEMENTS)
+        else:
+            conn = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT, cached_statements=SQLITE_CACHED_STATEMENTS)
+        conn.row_factory = sqlite3.Row
+        configure_connection(conn)
+        connections[(path, _read_only)] = conn
+    return conn
+
+
+# Runs create(conn) once per process for the named set of tables
+def ensure_schema(name, create, path=None):
+    if _read_only:
+        return
+    path = path or DATABASE_PATH
+    key = (path, name)
+    if key in _schemas_ready:
+        return
+    with _schema_lock:
+        if key in _schemas_ready:
+            return
+        conn = get_connection(path)
+        with conn:
+            create(conn)
+        _schemas_ready.add(key)
+
+
+def create_catalog_table(conn):
+    # plex_debrid's catalog layout; only created here when the database is new
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS catalog (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            eid TEXT,
+            title TEXT,
+            type TEXT,
+            year TEXT,
+            parent_eid TEXT,
+            parent_title TEXT,
+            parent_type TEXT,
+            parent_year TEXT,
+            grandparent_eid TEXT,
+            grandparent_title TEXT,
+            grandparent_type TEXT,
+            grandparent_year TEXT,
+            torrent_file_name TEXT,
+            actual_title TEXT,
+            processed_dir_name TEXT,
+            final_symlink_path TEXT
+        )
+    ''')
+
+
+def create_catalog_indexes(conn):
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_catalog_processed_dir_name ON catalog (processed_dir_name)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_catalog_torrent_file_name ON catalog (torrent_file_name)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_catalog_eid ON catalog (eid)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_catalog_parent_eid ON catalog (parent_eid)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_catalog_grandparent_eid ON catalog (grandparent_eid)')
+    # The incremental pass only ever looks for rows that have not been linked yet
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_catalog_unprocessed ON catalog (id)
+        WHERE processed_dir_name IS NULL OR processed_dir_name = ''
+    ''')
+
+
+def add_catalog_import_hash(conn):
+    # Lets catalog_import skip rows that have not changed since the last import
+    conn.execute('ALTER TABLE catalog ADD COLUMN import_hash TEXT')
+
+
+def create_catalog_symlink_index(conn):
+    # The reconciler looks up which sources are linked into each library folder
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_catalog_final_symlink_path ON catalog (final_symlink_path)')
+
+
+# Applied in order; the database's user_version is the number applied so far
+MIGRATIONS = [
+    create_catalog_table,
+    create_catalog_indexes,
+    add_catalog_import_hash,
+    create_catalog_symlink_index,
+]
+
+
+def migrate(conn):
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        print(f"Applying schema migration {number}: {migration.__name__}")
+        # DDL does not open a transaction implicitly, so each step is wrapped explicitly
+        conn.execute('BEGIN')
+        try:
+            migration(conn)
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+
+def migrated_connection(path=None):
+    ensure_schema('migrations', migrate, path)
+    return get_connection(path)
+
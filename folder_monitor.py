@@ -1,41 +1,272 @@
 import time
+import threading
+import json
 from watchdog.observers.polling import PollingObserver as Observer
 from watchdog.events import FileSystemEventHandler
-from pd_symlinker import create_symlinks
+from pd_symlinker import create_symlinks, get_source_index, VIDEO_EXTENSIONS
+from reconciler import Reconciler, RECONCILE_INTERVAL
 import os
 
+EVENT_QUIET_WINDOW = float(os.getenv('EVENT_QUIET_WINDOW', '10'))
+EVENT_MAX_DELAY = float(os.getenv('EVENT_MAX_DELAY', '120'))
+WATCH_MODE = os.getenv('WATCH_MODE', 'snapshot')  # 'snapshot' or 'polling' (watchdog)
+WATCH_INTERVAL = float(os.getenv('WATCH_INTERVAL', '30'))
+WATCH_DEPTH = int(os.getenv('WATCH_DEPTH', '1'))
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', '/data/source_snapshot.json')
+# Full passes retry folders that targeted passes never revisit, like failed lookups; 0 disables
+FULL_PASS_INTERVAL = float(os.getenv('FULL_PASS_INTERVAL', '3600'))
+
+
+# Runs one pass per burst of events, after a quiet window or at most max_delay after the first
+class PassScheduler:
+    def __init__(self, run_pass, quiet_window=EVENT_QUIET_WINDOW, max_delay=EVENT_MAX_DELAY):
+        self.run_pass = run_pass
+        self.quiet_window = quiet_window
+        self.max_delay = max_delay
+        self.condition = threading.Condition()
+        self.pending = False
+        self.running = False
+        self.touched_dirs = set()
+        self.full_pass = False
+        self.first_event = None
+        self.last_event = None
+        self.thread = threading.Thread(target=self._loop, name='pass-scheduler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def busy(self):
+        with self.condition:
+            return self.pending or self.running
+
+    def notify(self, touched_dir=None):
+        with self.condition:
+            if touched_dir is None:
+                self.full_pass = True
+            else:
+                self.touched_dirs.add(touched_dir)
+            now = time.monotonic()
+            if not self.pending:
+                self.pending = True
+                self.first_event = now
+            self.last_event = now
+            self.condition.notify()
+
+    def _wait_for_quiet(self):
+        while True:
+            now = time.monotonic()
+            deadline = min(self.last_event + self.quiet_window, self.first_event + self.max_delay)
+            if now >= deadline:
+                return
+            self.condition.wait(deadline - now)
+
+    def _loop(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                self._wait_for_quiet()
+                touched_dirs = None if self.full_pass else self.touched_dirs
+                self.pending = False
+                self.running = True
+                self.touched_dirs = set()
+                self.full_pass = False
+            try:
+                self.run_pass(touched_dirs)
+            except Exception as e:
+                print(f"Error in scheduled pass: {e}")
+            finally:
+                with self.condition:
+                    self.running = False
+
+
+# Compares directory mtimes down to depth and only lists directories that changed
+class SnapshotWatcher:
+    def __init__(self, root, on_change, depth=WATCH_DEPTH, snapshot_path=SNAPSHOT_PATH):
+        self.root = root
+        self.on_change = on_change
+        self.depth = depth
+        self.snapshot_path = snapshot_path
+        self.snapshot = {}  # relative directory path -> (mtime, {child name: file size, None for directories})
+        self.initialized = False
+        self.modified = False
+
+    def load(self):
+        try:
+            with open(self.snapshot_path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            print(f"Error loading source snapshot {self.snapshot_path}: {e}")
+            return False
+        if data.get('root') != self.root or data.get('depth') != self.depth:
+            print(f"Ignoring source snapshot for {data.get('root')} at depth {data.get('depth')}")
+            return False
+        self.snapshot = {rel: (mtime, children) for rel, (mtime, children) in data['entries'].items()}
+        self.initialized = True
+        print(f"Loaded source snapshot with {len(self.snapshot)} directories from {self.snapshot_path}")
+        return True
+
+    def save(self):
+        temp_path = f"{self.snapshot_path}.tmp"
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump({'root': self.root, 'depth': self.depth, 'entries': self.snapshot}, f)
+            os.replace(temp_path, self.snapshot_path)
+            self.modified = False
+        except OSError as e:
+            print(f"Error saving source snapshot {self.snapshot_path}: {e}")
+
+    def largest_video_files(self):
+        largest_files = {}
+        for rel, (_, children) in self.snapshot.items():
+            if not rel or os.sep in rel:
+                continue
+            videos = [(size, name) for name, size in children.items()
+                      if size is not None and os.path.splitext(name)[1].lower() in VIDEO_EXTENSIONS]
+            largest_files[rel] = max(videos)[1] if videos else None
+        return largest_files
+
+    def poll(self, notify=True):
+        changed = set()
+        self._check('', 0, changed)
+        first_poll = not self.initialized
+        self.initialized = True
+        if self.modified:
+            self.save()
+        if first_poll:
+            return set()
+        for name in changed:
+            print(f"Change detected in {os.path.join(self.root, name)}")
+            if notify:
+                self.on_change(name)
+        return changed
+
+    def _forget(self, rel):
+        prefix = rel + os.sep
+        for key in [key for key in self.snapshot if key == rel or key.startswith(prefix)]:
+            del self.snapshot[key]
+            self.modified = True
+
+    def _check(self, rel, level, changed):
+        path = os.path.join(self.root, rel) if rel else self.root
+        top_level = rel.split(os.sep)[0]
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError as e:
+            if not rel:
+                # Keep the snapshot while the mount is away; the next poll compares against it
+                print(f"Error reading source root {path}, skipping this poll: {e}")
+                return
+            self._forget(rel)
+            changed.add(top_level)
+            return
+
+        previous = self.snapshot.get(rel)
+        if previous is not None and previous[0] == mtime:
+            children = previous[1]
+        else:
+            children = {}
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        try:
+                            children[entry.name] = None if entry.is_dir() else entry.stat().st_size
+                        except OSError:
+                            children[entry.name] = 0
+            except OSError as e:
+                print(f"Error listing {path}: {e}")
+                return
+            self.snapshot[rel] = (mtime, children)
+            self.modified = True
+            old_children = previous[1] if previous is not None else {}
+            for name in set(old_children) - set(children):
+                self._forget(os.path.join(rel, name) if rel else name)
+            if level == 0:
+                changed.update(set(children) ^ set(old_children))
+            else:
+                changed.add(top_level)
+
+        if level < self.depth:
+            for name, size in children.items():
+                if size is None:
+                    self._check(os.path.join(rel, name) if rel else name, level + 1, changed)
+
+
 class FolderMonitor:
     def __init__(self, folder_to_monitor):
         self.folder_to_monitor = folder_to_monitor
         self.observer = Observer()
+        self.scheduler = PassScheduler(self.run_pass)
+        self.watcher = SnapshotWatcher(folder_to_monitor, self.scheduler.notify)
+        self.last_full_pass = time.monotonic()
+
+    def run_pass(self, touched_dirs=None):
+        create_symlinks(touched_dirs=touched_dirs)
+        print("create_symlinks() function executed.")
+
+    def schedule_full_pass(self):
+        if FULL_PASS_INTERVAL > 0 and time.monotonic() - self.last_full_pass >= FULL_PASS_INTERVAL:
+            self.last_full_pass = time.monotonic()
+            self.scheduler.notify(None)
+
+    def top_level_dir(self, path):
+        relative_path = os.path.relpath(path, self.folder_to_monitor)
+        top_level = relative_path.split(os.sep)[0]
+        if top_level in ('.', '..'):
+            return None
+        return top_level
 
     def run(self):
-        event_handler = self.Handler()
+        if WATCH_MODE == 'polling':
+            self.run_observer()
+        else:
+            self.run_snapshot_watcher()
+
+    def run_snapshot_watcher(self):
+        print(f"Starting snapshot watcher for {self.folder_to_monitor} (interval {WATCH_INTERVAL}s, depth {WATCH_DEPTH})")
+        self.scheduler.start()
+        try:
+            while True:
+                started = time.monotonic()
+                self.watcher.poll()
+                self.schedule_full_pass()
+                time.sleep(max(0, WATCH_INTERVAL - (time.monotonic() - started)))
+        except KeyboardInterrupt:
+            pass
+
+    def run_observer(self):
+        event_handler = self.Handler(self)
         self.observer.schedule(event_handler, self.folder_to_monitor, recursive=True)
         print(f"Starting polling observer for {self.folder_to_monitor}")
+        self.scheduler.start()
         self.observer.start()
         try:
             while True:
                 print("Polling observer is running...")
+                self.schedule_full_pass()
                 time.sleep(30)
         except KeyboardInterrupt:
             self.observer.stop()
         self.observer.join()
 
     class Handler(FileSystemEventHandler):
+        def __init__(self, monitor):
+            super().__init__()
+            self.monitor = monitor
+
         def on_any_event(self, event):
             if event.is_directory:
                 return None
             else:
                 print(f"Event detected: {event.event_type} - {event.src_path}")
-                create_symlinks()
-                print("create_symlinks() function executed.")
+                paths = [event.src_path, getattr(event, 'dest_path', None)]
+                for path in filter(None, paths):
+                    self.monitor.scheduler.notify(self.monitor.top_level_dir(path))
 
 if __name__ == '__main__':
-    print("Running Startup Scan")
-    create_symlinks()
     folder_to_monitor = os.getenv('SRC_DIR', '')
-    print("Monitoring Folder: " + folder_to_monitor)
 
     # Check if the folder exists
     if not os.path.exists(folder_to_monitor):
@@ -43,6 +274,21 @@ if __name__ == '__main__':
         exit(1)
 
     monitor = FolderMonitor(folder_to_monitor)
+    if WATCH_MODE != 'polling' and monitor.watcher.load():
+        print("Running Startup Scan of changes since the last run")
+        changed = monitor.watcher.poll(notify=False)
+        get_source_index(folder_to_monitor).seed_largest_files(monitor.watcher.largest_video_files())
+        create_symlinks(touched_dirs=changed)
+    else:
+        if WATCH_MODE != 'polling':
+            # Take the baseline first, so folders added during the scan show up as changes in the next poll
+            monitor.watcher.poll()
+        print("Running Startup Scan")
+        create_symlinks()
+    if RECONCILE_INTERVAL > 0:
+        print(f"Checking library symlinks in the background every {RECONCILE_INTERVAL}s")
+        Reconciler(folder_to_monitor).run_in_background(should_yield=monitor.scheduler.busy)
+    print("Monitoring Folder: " + folder_to_monitor)
     monitor.run()
 
 # import time
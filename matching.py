@@ -0,0 +1,74 @@
+import os
+import re
+
+from fuzzywuzzy import fuzz
+
+try:
+    # process.cdist returns a numpy array, so the batched backend needs both
+    import numpy  # noqa: F401
+    from rapidfuzz import fuzz as rapid_fuzz
+    from rapidfuzz import process as rapid_process
+except ImportError:
+    rapid_fuzz = None
+    rapid_process = None
+
+
+MATCH_ENGINE = os.getenv('MATCH_ENGINE', 'auto')
+MATCH_WORKERS = int(os.getenv('MATCH_WORKERS', '-1'))
+
+# Thresholds shared by every engine
+DIRECTORY_MATCH_THRESHOLD = 90
+CINEMETA_MATCH_THRESHOLD = 80
+
+
+def default_process(text):
+    # Same normalisation fuzzywuzzy's process.extractOne applies by default
+    return re.sub(r'(?ui)\W', ' ', str(text)).lower().strip()
+
+
+class PythonEngine:
+    name = 'fuzzywuzzy'
+
+    def score_many(self, queries, choices, processor=True):
+        if processor:
+            queries = [default_process(q) for q in queries]
+            choices = [default_process(c) for c in choices]
+        return [[fuzz.ratio(q, c) if q else 0 for c in choices] for q in queries]
+
+    # (query_index, choice_index, score) for the first query whose best choice reaches threshold
+    def first_match(self, queries, choices, threshold, processor=True):
+        choices = list(choices)
+        if not choices or not queries:
+            return None
+        for i, row in enumerate(self.score_many(queries, choices, processor=processor)):
+            best = max(range(len(choices)), key=row.__getitem__)
+            if row[best] >= threshold:
+                return i, best, row[best]
+        return None
+
+
+# Same normalised InDel ratio as fuzzywuzzy, rounded the same way so thresholds hold
+class RapidfuzzEngine(PythonEngine):
+    name = 'rapidfuzz'
+
+    def __init__(self, workers=MATCH_WORKERS):
+        self.workers = workers
+
+    def score_many(self, queries, choices, processor=True):
+        if processor:
+            queries = [default_process(q) for q in queries]
+            choices = [default_process(c) for c in choices]
+        matrix = rapid_process.cdist(queries, choices, scorer=rapid_fuzz.ratio, workers=self.workers)
+        return [[int(round(score)) if q else 0 for score in row] for q, row in zip(queries, matrix.tolist())]
+
+
+def get_engine(name=MATCH_ENGINE):
+    if name == 'fuzzywuzzy' or (name == 'auto' and rapid_process is None):
+        return PythonEngine()
+    if rapid_process is None:
+        print(f"Match engine '{name}' requested but rapidfuzz/numpy is not installed, falling back to fuzzywuzzy")
+        return PythonEngine()
+    return RapidfuzzEngine()
+
+
+engine = get_engine()
@@ -0,0 +1,402 @@
+import os
+import sqlite3
+import threading
+import time
+import json
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from database import ensure_schema, get_connection, is_read_only
+
+
+PROBE_FAILURE_TTL = int(os.getenv('PROBE_FAILURE_TTL', '86400'))
+PROBE_BYTE_BUDGET = int(os.getenv('PROBE_BYTE_BUDGET', str(256 * 1024)))
+PROBE_TIMEOUT = float(os.getenv('PROBE_TIMEOUT', '10'))
+PROBE_READ_SIZE = 8192
+PROBE_WORKERS = int(os.getenv('PROBE_WORKERS', '4'))
+# Header parsing and the ffprobe fallback each get PROBE_TIMEOUT, plus slack for the stat and cache lookups
+PROBE_WAIT_TIMEOUT = float(os.getenv('PROBE_WAIT_TIMEOUT', str(2 * PROBE_TIMEOUT + 5)))
+
+
+def _create_probe_cache(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS probe_cache (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime REAL,
+            width INTEGER,
+            height INTEGER,
+            codec TEXT,
+            probed_at REAL
+        )
+    ''')
+
+
+def _connect():
+    ensure_schema('probe_cache', _create_probe_cache)
+    return get_connection()
+
+
+def read_probe_cache(path, size, mtime):
+    try:
+        row = _connect().execute(
+            'SELECT width, height, codec, probed_at FROM probe_cache WHERE path = ? AND size = ? AND mtime = ?',
+            (path, size, mtime)
+        ).fetchone()
+    except sqlite3.OperationalError:
+        # A read-only database may not have the table yet
+        if not is_read_only():
+            raise
+        return None
+    if row is None:
+        return None
+    width, height, codec, probed_at = row
+    if width is None and time.time() - probed_at > PROBE_FAILURE_TTL:
+        return None
+    return width, height, codec
+
+
+def write_probe_cache(path, size, mtime, width, height, codec):
+    if is_read_only():
+        return
+    conn = _connect()
+    with conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO probe_cache (path, size, mtime, width, height, codec, probed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (path, size, mtime, width, height, codec, time.time()))
+
+
+class ProbeLimitExceeded(Exception):
+    pass
+
+
+# Ranged reads bounded by a byte budget and a deadline, served from one cached block
+class BudgetReader:
+    def __init__(self, f, budget=PROBE_BYTE_BUDGET, timeout=PROBE_TIMEOUT):
+        self.f = f
+        self.size = os.fstat(f.fileno()).st_size
+        self.remaining = budget
+        self.deadline = time.monotonic() + timeout
+        self.block_start = 0
+        self.block = b''
+
+    def read_at(self, offset, n):
+        if self.block_start <= offset and offset + n <= self.block_start + len(self.block):
+            start = offset - self.block_start
+            return self.block[start:start + n]
+        if offset + n > self.size:
+            raise ValueError(f"read past end of file at {offset}")
+        length = min(max(n, PROBE_READ_SIZE), self.size - offset)
+        if length > self.remaining:
+            length = n
+        if length > self.remaining:
+            raise ProbeLimitExceeded(f"byte budget exhausted at offset {offset}")
+        if time.monotonic() > self.deadline:
+            raise ProbeLimitExceeded(f"timed out at offset {offset}")
+        self.f.seek(offset)
+        self.block = self.f.read(length)
+        self.block_start = offset
+        self.remaining -= len(self.block)
+        if len(self.block) < n:
+            raise ValueError(f"short read at {offset}")
+        return self.block[:n]
+
+    def read_uint(self, offset, n):
+        return int.from_bytes(self.read_at(offset, n), 'big')
+
+
+# Matroska / WebM
+
+EBML_ID = 0x1A45DFA3
+SEGMENT_ID = 0x18538067
+SEEKHEAD_ID = 0x114D9B74
+SEEK_ID = 0x4DBB
+SEEK_ELEMENT_ID = 0x53AB
+SEEK_POSITION_ID = 0x53AC
+TRACKS_ID = 0x1654AE6B
+CLUSTER_ID = 0x1F43B675
+TRACK_ENTRY_ID = 0xAE
+TRACK_TYPE_ID = 0x83
+CODEC_ID = 0x86
+VIDEO_ID = 0xE0
+PIXEL_WIDTH_ID = 0xB0
+PIXEL_HEIGHT_ID = 0xBA
+
+
+def _read_vint(reader, offset, keep_marker):
+    first = reader.read_at(offset, 1)[0]
+    if not first:
+        raise ValueError(f"invalid EBML vint at {offset}")
+    length = 9 - first.bit_length()
+    value = reader.read_uint(offset, length)
+    if keep_marker:
+        return value, length
+    value &= (1 << (7 * length)) - 1
+    if value == (1 << (7 * length)) - 1:
+        return None, length  # unknown size
+    return value, length
+
+
+def _ebml_element(reader, offset):
+    element_id, id_length = _read_vint(reader, offset, keep_marker=True)
+    size, size_length = _read_vint(reader, offset + id_length, keep_marker=False)
+    return element_id, offset + id_length + size_length, size
+
+
+def _ebml_children(reader, start, end):
+    offset = start
+    while offset < end:
+        element_id, data, size = _ebml_element(reader, offset)
+        if size is None:
+            return
+        yield element_id, data, size
+        offset = data + size
+
+
+def _parse_matroska_tracks(reader, start, end):
+    for element_id, data, size in _ebml_children(reader, start, end):
+        if element_id != TRACK_ENTRY_ID:
+            continue
+        track_type = codec = width = height = None
+        for child_id, child_data, child_size in _ebml_children(reader, data, data + size):
+            if child_id == TRACK_TYPE_ID:
+                track_type = reader.read_uint(child_data, child_size)
+            elif child_id == CODEC_ID:
+                codec = reader.read_at(child_data, min(child_size, 64)).decode('ascii', 'replace').rstrip('\x00')
+            elif child_id == VIDEO_ID:
+                for video_id, video_data, video_size in _ebml_children(reader, child_data, child_data + child_size):
+                    if video_id == PIXEL_WIDTH_ID:
+                        width = reader.read_uint(video_data, video_size)
+                    elif video_id == PIXEL_HEIGHT_ID:
+                        height = reader.read_uint(video_data, video_size)
+        if track_type == 1 and width and height:
+            return width, height, codec
+    return None
+
+
+def _parse_matroska_seekhead(reader, start, end):
+    for element_id, data, size in _ebml_children(reader, start, end):
+        if element_id != SEEK_ID:
+            continue
+        seek_id = seek_position = None
+        for child_id, child_data, child_size in _ebml_children(reader, data, data + size):
+            if child_id == SEEK_ELEMENT_ID:
+                seek_id = reader.read_uint(child_data, child_size)
+            elif child_id == SEEK_POSITION_ID:
+                seek_position = reader.read_uint(child_data, child_size)
+        if seek_id == TRACKS_ID and seek_position is not None:
+            return seek_position
+    return None
+
+
+def probe_matroska(reader):
+    element_id, data, size = _ebml_element(reader, 0)
+    if element_id != EBML_ID or size is None:
+        return None
+    element_id, segment_start, size = _ebml_element(reader, data + size)
+    if element_id != SEGMENT_ID:
+        return None
+    segment_end = reader.size if size is None else min(segment_start + size, reader.size)
+
+    offset = segment_start
+    jumped = False
+    while offset < segment_end:
+        element_id, data, size = _ebml_element(reader, offset)
+        if element_id == TRACKS_ID and size is not None:
+            return _parse_matroska_tracks(reader, data, data + size)
+        if element_id == SEEKHEAD_ID and size is not None and not jumped:
+            position = _parse_matroska_seekhead(reader, data, data + size)
+            if position is not None:
+                offset = segment_start + position
+                jumped = True
+                continue
+        if element_id == CLUSTER_ID or size is None:
+            return None  # Tracks must precede the media data we are not going to read
+        offset = data + size
+    return None
+
+
+# MP4 / QuickTime
+
+MP4_TOP_LEVEL_BOXES = {b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide', b'pnot'}
+
+
+def _mp4_boxes(reader, start, end):
+    offset = start
+    while offset + 8 <= end:
+        size = reader.read_uint(offset, 4)
+        box_type = reader.read_at(offset + 4, 4)
+        header_length = 8
+        if size == 1:
+            size = reader.read_uint(offset + 8, 8)
+            header_length = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_length:
+            raise ValueError(f"invalid MP4 box size at {offset}")
+        yield box_type, offset + header_length, offset + size
+        offset += size
+
+
+def _mp4_child(reader, start, end, box_type):
+    for child_type, child_start, child_end in _mp4_boxes(reader, start, end):
+        if child_type == box_type:
+            return child_start, child_end
+    return None
+
+
+def _parse_mp4_track(reader, start, end):
+    width = height = codec = None
+    handler = None
+    tkhd = _mp4_child(reader, start, end, b'tkhd')
+    if tkhd:
+        dims_offset = tkhd[0] + (88 if reader.read_at(tkhd[0], 1)[0] == 1 else 76)
+        width = reader.read_uint(dims_offset, 4) >> 16
+        height = reader.read_uint(dims_offset + 4, 4) >> 16
+
+    mdia = _mp4_child(reader, start, end, b'mdia')
+    if not mdia:
+        return None
+    hdlr = _mp4_child(reader, mdia[0], mdia[1], b'hdlr')
+    if hdlr:
+        handler = reader.read_at(hdlr[0] + 8, 4)
+    if handler != b'vide':
+        return None
+
+    stsd = None
+    minf = _mp4_child(reader, mdia[0], mdia[1], b'minf')
+    stbl = minf and _mp4_child(reader, minf[0], minf[1], b'stbl')
+    if stbl:
+        stsd = _mp4_child(reader, stbl[0], stbl[1], b'stsd')
+    if stsd and stsd[1] - stsd[0] >= 8 + 36:
+        entry = stsd[0] + 8
+        codec = reader.read_at(entry + 4, 4).decode('ascii', 'replace')
+        if not (width and height):
+            width = reader.read_uint(entry + 32, 2)
+            height = reader.read_uint(entry + 34, 2)
+    if width and height:
+        return width, height, codec
+    return None
+
+
+def probe_mp4(reader):
+    for box_type, start, end in _mp4_boxes(reader, 0, reader.size):
+        if box_type not in MP4_TOP_LEVEL_BOXES:
+            return None
+        if box_type != b'moov':
+            continue
+        for child_type, child_start, child_end in _mp4_boxes(reader, start, end):
+            if child_type == b'trak':
+                result = _parse_mp4_track(reader, child_start, child_end)
+                if result:
+                    return result
+        return None
+    return None
+
+
+# Reads (width, height, codec) from Matroska or MP4 headers; None for other containers
+def probe_headers(file_path, budget=PROBE_BYTE_BUDGET, timeout=PROBE_TIMEOUT):
+    with open(file_path, 'rb') as f:
+        reader = BudgetReader(f, budget=budget, timeout=timeout)
+        if reader.size < 12:
+            return None
+        magic = reader.read_at(0, 12)
+        try:
+            if magic[:4] == b'\x1a\x45\xdf\xa3':
+                return probe_matroska(reader)
+            if magic[4:8] in MP4_TOP_LEVEL_BOXES:
+                return probe_mp4(reader)
+        except ProbeLimitExceeded as e:
+            print(f"Header probe of {file_path} stopped: {e} ({budget - reader.remaining} bytes read)")
+    return None
+
+
+def probe_with_ffprobe(file_path, budget=PROBE_BYTE_BUDGET, timeout=PROBE_TIMEOUT):
+    if not shutil.which('ffprobe'):
+        return None
+    result = subprocess.run(
+        [
+            'ffprobe', '-v', 'error', '-probesize', str(max(budget, 32)),
+            '-select_streams', 'v:0', '-show_entries', 'stream=width,height,codec_name',
+            '-of', 'json', file_path
+        ],
+        capture_output=True, text=True, timeout=timeout
+    )
+    streams = json.loads(result.stdout or '{}').get('streams') or []
+    if not streams or not streams[0].get('width'):
+        return None
+    stream = streams[0]
+    return stream.get('width'), stream.get('height'), stream.get('codec_name')
+
+
+# Results, failures included, are cached by path, size and mtime
+def probe_video(file_path):
+    try:
+        st = os.stat(file_path)
+    except OSError as e:
+        print(f"Error reading {file_path}: {e}")
+        return None, None, None
+
+    cached = read_probe_cache(file_path, st.st_size, st.st_mtime)
+    if cached is not None:
+        return cached
+
+    result = None
+    try:
+        result = probe_headers(file_path)
+    except (OSError, ValueError) as e:
+        print(f"Error reading container headers of {file_path}: {e}")
+    if result is None:
+        try:
+            result = probe_with_ffprobe(file_path)
+        except (OSError, ValueError, subprocess.SubprocessError) as e:
+            print(f"Error getting resolution with ffprobe: {e}")
+    width, height, codec = result or (None, None, None)
+
+    try:
+        write_probe_cache(file_path, st.st_size, st.st_mtime, width, height, codec)
+    except sqlite3.Error as e:
+        print(f"Error caching probe result for {file_path}: {e}")
+    return width, height, codec
+
+
+# A path that is already being probed shares its future
+class ProbePool:
+    def __init__(self, workers=PROBE_WORKERS, timeout=PROBE_WAIT_TIMEOUT):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='probe')
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.inflight = {}  # path -> future
+
+    def _run(self, file_path):
+        try:
+            return probe_video(file_path)
+        finally:
+            with self.lock:
+                self.inflight.pop(file_path, None)
+
+    def submit(self, file_path):
+        with self.lock:
+            future = self.inflight.get(file_path)
+            if future is None:
+                future = self.inflight[file_path] = self.executor.submit(self._run, file_path)
+            return future
+
+    def result(self, future, file_path):
+        # The timeout covers time queued behind hung probes too, so a stuck mount cannot stall the pass
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            if future.cancel():
+                with self.lock:
+                    if self.inflight.get(file_path) is future:
+                        del self.inflight[file_path]
+            print(f"Probe of {file_path} timed out after {self.timeout}s")
+            return None, None, None
+
+    def probe(self, file_path):
+        return self.result(self.submit(file_path), file_path)
+
+
+probe_pool = ProbePool()
@@ -0,0 +1,230 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import quote
+import requests
+from requests.adapters import HTTPAdapter
+from matching import engine, CINEMETA_MATCH_THRESHOLD
+from database import ensure_schema, get_connection, is_read_only
+
+
+CINEMETA_HIT_TTL = int(os.getenv('CINEMETA_HIT_TTL', str(30 * 86400)))
+CINEMETA_MISS_TTL = int(os.getenv('CINEMETA_MISS_TTL', str(86400)))
+CINEMETA_ERROR_TTL = int(os.getenv('CINEMETA_ERROR_TTL', '600'))
+CINEMETA_CACHE_SIZE = int(os.getenv('CINEMETA_CACHE_SIZE', '50000'))
+CINEMETA_URL = os.getenv('CINEMETA_URL', 'https://v3-cinemeta.strem.io')
+CINEMETA_TIMEOUT = float(os.getenv('CINEMETA_TIMEOUT', '10'))
+CINEMETA_CONCURRENCY = int(os.getenv('CINEMETA_CONCURRENCY', '4'))
+CINEMETA_RATE_LIMIT = float(os.getenv('CINEMETA_RATE_LIMIT', '5'))  # requests per second, 0 for no limit
+CINEMETA_RETRIES = int(os.getenv('CINEMETA_RETRIES', '3'))
+CINEMETA_BACKOFF = float(os.getenv('CINEMETA_BACKOFF', '0.5'))
+
+# Lookup outcomes stored in the cache
+HIT = 'hit'
+MISS = 'miss'
+ERROR = 'error'
+
+TTLS = {HIT: CINEMETA_HIT_TTL, MISS: CINEMETA_MISS_TTL, ERROR: CINEMETA_ERROR_TTL}
+cache_lock = threading.Lock()
+_writes_since_eviction = 0
+
+
+def _create_lookup_cache(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS cinemeta_cache (
+            key TEXT PRIMARY KEY,
+            status TEXT,
+            result TEXT,
+            fetched_at REAL,
+            accessed_at REAL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_cinemeta_cache_accessed_at ON cinemeta_cache (accessed_at)')
+
+
+def _connect():
+    ensure_schema('cinemeta_cache', _create_lookup_cache)
+    return get_connection()
+
+
+def lookup_cache_key(kind, title, year=None):
+    normalized = re.sub(r'\s+', ' ', title).strip().lower()
+    return f"{kind}|{normalized}|{year or ''}"
+
+
+# (status, result) for a fresh cache entry, or None
+def read_lookup_cache(key):
+    now = time.time()
+    conn = _connect()
+    try:
+        row = conn.execute('SELECT status, result, fetched_at FROM cinemeta_cache WHERE key = ?', (key,)).fetchone()
+    except sqlite3.OperationalError:
+        # A read-only database may not have the table yet
+        if not is_read_only():
+            raise
+        return None
+    if row is None or now - row[2] > TTLS.get(row[0], 0):
+        return None
+    if is_read_only():
+        return row[0], row[1]
+    with conn:
+        conn.execute('UPDATE cinemeta_cache SET accessed_at = ? WHERE key = ?', (now, key))
+    return row[0], row[1]
+
+
+def write_lookup_cache(key, status, result):
+    global _writes_since_eviction
+    if is_read_only():
+        return
+    now = time.time()
+    conn = _connect()
+    with conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO cinemeta_cache (key, status, result, fetched_at, accessed_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (key, status, result, now, now))
+    with cache_lock:
+        _writes_since_eviction += 1
+        # Checking the size on every write would cost a COUNT(*) per lookup
+        evict = _writes_since_eviction >= max(1, CINEMETA_CACHE_SIZE // 100)
+        if evict:
+            _writes_since_eviction = 0
+    if evict:
+        with conn:
+            excess = conn.execute('SELECT COUNT(*) FROM cinemeta_cache').fetchone()[0] - CINEMETA_CACHE_SIZE
+            if excess > 0:
+                conn.execute('''
+                    DELETE FROM cinemeta_cache WHERE key IN (
+                        SELECT key FROM cinemeta_cache ORDER BY accessed_at LIMIT ?
+                    )
+                ''', (excess,))
+
+
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.lock = threading.Lock()
+        self.next_slot = 0
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+# Cinemeta lookups over a pooled session, rate limited and retried, sharing in-flight requests
+class CinemetaClient:
+    def __init__(self, base_url=CINEMETA_URL, timeout=CINEMETA_TIMEOUT, concurrency=CINEMETA_CONCURRENCY,
+                 rate_limit=CINEMETA_RATE_LIMIT, retries=CINEMETA_RETRIES, backoff=CINEMETA_BACKOFF):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='cinemeta')
+        self.lock = threading.Lock()
+        self.inflight = {}  # cache key -> future
+
+    def _retry_delay(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        return self.backoff * (2 ** attempt)
+
+    def search_movies(self, title):
+        url = f"{self.base_url}/catalog/movie/top/search={quote(title)}.json"
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.retries:
+                    raise
+                time.sleep(self._retry_delay(attempt))
+                attempt += 1
+                continue
+            if (response.status_code == 429 or response.status_code >= 500) and attempt < self.retries:
+                time.sleep(self._retry_delay(attempt, response))
+                attempt += 1
+                continue
+            if response.status_code != 200:
+                return response.status_code, None
+            return 200, response.json().get('metas') or []
+
+    def fetch_movie_info(self, title, year=None):
+        try:
+            status_code, movie_options = self.search_movies(title)
+        except (requests.RequestException, ValueError) as e:
+            print(f"Error fetching movie information: {e}")
+            return ERROR, f'{title} {year}'
+
+        if status_code != 200:
+            print(f"Error fetching movie information: HTTP {status_code}")
+            return ERROR, title
+
+        if not movie_options:
+            print(f"No Cinemeta results for '{title}'. Returning original title.")
+            return MISS, title
+
+        # Use stricter matching criteria: no default processing, just case and whitespace
+        candidates = [(movie_info.get('name') or '').lower().strip() for movie_info in movie_options]
+        scores = engine.score_many([title.lower().strip()], candidates, processor=False)[0]
+        best_index = max(range(len(scores)), key=scores.__getitem__)
+        highest_score = scores[best_index]
+        movie_info = movie_options[best_index]
+        best_match = f"{movie_info.get('name')} ({movie_info.get('releaseInfo')}) {{imdb-{movie_info.get('imdb_id')}}}"
+
+        # Reject outright if the best match score is too low
+        if highest_score >= CINEMETA_MATCH_THRESHOLD:
+            return HIT, best_match
+        print(f"Rejected match for '{title}' with best score {highest_score}. Returning original title.")
+        return MISS, title
+
+    def _lookup(self, key, title, year):
+        try:
+            status, result = self.fetch_movie_info(title, year)
+            try:
+                write_lookup_cache(key, status, result)
+            except sqlite3.Error as e:
+                print(f"Error caching movie information for '{title}': {e}")
+            return status, result
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+
+    def submit_movie_info(self, title, year=None):
+        key = lookup_cache_key('movie', title, year)
+        with self.lock:
+            future = self.inflight.get(key)
+            if future is not None:
+                return future
+        cached = read_lookup_cache(key)
+        if cached is not None:
+            future = Future()
+            future.set_result(cached)
+            return future
+        with self.lock:
+            future = self.inflight.get(key)
+            if future is None:
+                future = self.inflight[key] = self.executor.submit(self._lookup, key, title, year)
+            return future
+
+    def movie_info(self, title, year=None):
+        # (status, result), where status is HIT, MISS or ERROR
+        return self.submit_movie_info(title, year).result()
+
+
+cinemeta_client = CinemetaClient()
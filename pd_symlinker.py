@@ -5,51 +5,347 @@ import subprocess
 import json
 from datetime import datetime
 from colorama import init
-from fuzzywuzzy import fuzz
-from fuzzywuzzy import process
-from moviepy.editor import VideoFileClip
+from matching import engine, DIRECTORY_MATCH_THRESHOLD
+from media_probe import probe_pool
+from metadata import cinemeta_client, ERROR
+from catalog_import import import_catalog, CATALOG_PATH
+from database import DATABASE_PATH, ensure_schema, get_connection, migrated_connection, set_read_only
 import threading
+import functools
+import heapq
+import itertools
+import math
+import argparse
+import contextlib
+import sys
 # from organisemedia import process_unaccounted_folder
 import time
-import requests
 
 
 # Constants
-DEFAULT_CATALOG_PATH = '/data/catalog.csv'
 PROCESSED_ITEMS_FILE = '/data/processed_items.txt'
 SRC_DIR = os.getenv('SRC_DIR', '')
 DEST_DIR = os.getenv('DEST_DIR', '')
 src_dir = SRC_DIR
 dest_dir = os.path.join(DEST_DIR, "shows")
 dest_dir_movies = os.path.join(DEST_DIR, "movies")
-DATABASE_PATH = '/data/media_database.db'
-db_lock = threading.Lock()
+INCREMENTAL_CATALOG = os.getenv('INCREMENTAL_CATALOG', 'true').lower() != 'false'
+CATALOG_FULL_SCAN_INTERVAL = int(os.getenv('CATALOG_FULL_SCAN_INTERVAL', '3600'))
+MATCH_BLOCKING = os.getenv('MATCH_BLOCKING', 'true').lower() != 'false'
+MATCH_CANDIDATE_CAP = int(os.getenv('MATCH_CANDIDATE_CAP', '50'))
+# Columns of the catalog table the symlink pass reads
+CATALOG_PASS_COLUMNS = ('id, eid, title, type, year, parent_eid, parent_title, parent_year, grandparent_eid, '
+                        'grandparent_title, grandparent_year, torrent_file_name, actual_title, processed_dir_name')
+SYMLINK_BATCH_SIZE = int(os.getenv('SYMLINK_BATCH_SIZE', '1000'))
+SYMLINK_ATOMIC = os.getenv('SYMLINK_ATOMIC', 'false').lower() == 'true'
+CATALOG_READ_CHUNK = int(os.getenv('CATALOG_READ_CHUNK', '1000'))
+CATALOG_WRITE_BATCH_SIZE = int(os.getenv('CATALOG_WRITE_BATCH_SIZE', '500'))
+CATALOG_WRITE_INTERVAL = float(os.getenv('CATALOG_WRITE_INTERVAL', '5'))
+# Catalog rows matched and probed ahead of the one being linked
+CATALOG_PREFETCH = int(os.getenv('CATALOG_PREFETCH', '16'))
 
 # Initialize colorama
 init(autoreset=True)
 
 
-def read_catalog_db():
-    with db_lock:
-        conn = sqlite3.connect(DATABASE_PATH)
-        c = conn.cursor()
-        c.execute('SELECT * FROM catalog')
-        rows = c.fetchall()
-        conn.close()
+# Seeks past the last id seen, so only one chunk is held and no read cursor stays open
+def iter_catalog_rows(condition='1', params=(), chunk_size=None):
+    chunk_size = chunk_size or CATALOG_READ_CHUNK
+    last_id = -1
+    while True:
+        rows = migrated_connection().execute(f'''
+            SELECT {CATALOG_PASS_COLUMNS} FROM catalog
+            WHERE id > ? AND {condition}
+            ORDER BY id LIMIT ?
+        ''', (last_id, *params, chunk_size)).fetchall()
+        yield from rows
+        if len(rows) < chunk_size:
+            return
+        last_id = rows[-1]['id']
+
+
+def iter_unprocessed_catalog_rows(after_id=0, up_to_id=None):
+    # The processed_dir_name condition matches idx_catalog_unprocessed so the partial index is used
+    condition = "(processed_dir_name IS NULL OR processed_dir_name = '') AND id > ?"
+    params = [after_id]
+    if up_to_id is not None:
+        condition += ' AND id <= ?'
+        params.append(up_to_id)
+    return iter_catalog_rows(condition, params)
+
+
+def read_catalog_rows_by_id(ids):
+    ids = list(ids)
+    conn = migrated_connection()
+    # Stay well below SQLite's bound-parameter limit
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        placeholders = ', '.join('?' for _ in chunk)
+        yield from conn.execute(f'''
+            SELECT {CATALOG_PASS_COLUMNS} FROM catalog
+            WHERE id IN ({placeholders}) AND (processed_dir_name IS NULL OR processed_dir_name = '')
+        ''', chunk).fetchall()
+
+
+def read_max_catalog_id():
+    max_id = migrated_connection().execute('SELECT MAX(id) FROM catalog').fetchone()[0]
+    return max_id or 0
+
+
+def read_catalog_rows_by_processed_dir(dir_paths):
+    dir_paths = list(dir_paths)
+    conn = migrated_connection()
+    for start in range(0, len(dir_paths), 500):
+        chunk = dir_paths[start:start + 500]
+        placeholders = ', '.join('?' for _ in chunk)
+        yield from conn.execute(
+            f'SELECT {CATALOG_PASS_COLUMNS} FROM catalog WHERE processed_dir_name IN ({placeholders})', chunk
+        ).fetchall()
+
+
+def read_processed_dir_names(dir_paths=None):
+    # Answered from idx_catalog_processed_dir_name alone; with dir_paths only those are looked up
+    conn = migrated_connection()
+    if dir_paths is None:
+        rows = conn.execute("SELECT DISTINCT processed_dir_name FROM catalog WHERE processed_dir_name > ''").fetchall()
+    else:
+        dir_paths = list(dir_paths)
+        rows = []
+        for start in range(0, len(dir_paths), 500):
+            chunk = dir_paths[start:start + 500]
+            placeholders = ', '.join('?' for _ in chunk)
+            rows.extend(conn.execute(
+                f'SELECT DISTINCT processed_dir_name FROM catalog WHERE processed_dir_name IN ({placeholders})', chunk
+            ).fetchall())
+    return {os.path.basename(row['processed_dir_name']) for row in rows}
+
+
+# Rows above a high-water mark on the id, plus unmatched rows retried once the source changes.
+# Rows edited in place (e.g. by catalog_import) wait for the full scan every CATALOG_FULL_SCAN_INTERVAL seconds.
+class CatalogWorkQueue:
+    def __init__(self, full_scan_interval=CATALOG_FULL_SCAN_INTERVAL):
+        self.lock = threading.Lock()
+        self.full_scan_interval = full_scan_interval
+        self.high_water_id = 0
+        self.pending = NameIndex()  # catalog id -> torrent name and title
+        self.queued_ids = set()
+        self.dirty = False
+        self.last_full_scan = None
+        self.unfinished = None  # (up_to_id, retry ids, dirty) of the last collect until finish is called
+
+    def mark_dirty(self):
+        with self.lock:
+            self.dirty = True
+
+    def enqueue(self, ids):
+        with self.lock:
+            self.queued_ids.update(ids)
+
+    def reset(self):
+        with self.lock:
+            self.high_water_id = 0
+            self.pending = NameIndex()
+            self.queued_ids.clear()
+            self.dirty = False
+            self.last_full_scan = None
+            self.unfinished = None
+
+    # With touched_dirs, only pending rows sharing tokens with those names are retried
+    def collect(self, touched_dirs=None):
+        with self.lock:
+            if self.unfinished is not None:
+                # The previous pass stopped early; retry what it was given
+                _, unread_ids, was_dirty = self.unfinished
+                self.queued_ids |= unread_ids
+                self.dirty = self.dirty or was_dirty
+                self.unfinished = None
+            now = time.monotonic()
+            if self.last_full_scan is None or now - self.last_full_scan >= self.full_scan_interval:
+                self.high_water_id = 0
+                self.pending = NameIndex()
+                self.queued_ids.clear()
+                self.dirty = False
+                self.last_full_scan = now
+
+            after_id = self.high_water_id
+            up_to_id = read_max_catalog_id()
+            retry_ids = set(self.queued_ids)
+            if touched_dirs is not None:
+                for name in touched_dirs:
+                    exact = self.pending.lookup_exact(name)
+                    if exact is not None:
+                        retry_ids.add(exact)
+                    retry_ids.update(self.pending.candidates([name]))
+            elif self.dirty:
+                retry_ids |= set(self.pending.texts)
+            self.unfinished = (up_to_id, set(retry_ids), self.dirty)
+            self.queued_ids.clear()
+            self.dirty = False
+
+        # Rows above after_id are streamed below anyway
+        retry_ids = {id for id in retry_ids if id <= after_id}
+        print(f"Catalog pass: unprocessed rows after id {after_id} up to {up_to_id}, {len(retry_ids)} retried")
+        rows = iter_unprocessed_catalog_rows(after_id, up_to_id)
+        if retry_ids:
+            rows = itertools.chain(rows, read_catalog_rows_by_id(sorted(retry_ids)))
         return rows
 
+    def finish(self):
+        # Only move the high-water mark once the rows from collect have all been read
+        with self.lock:
+            if self.unfinished is not None:
+                self.high_water_id = max(self.high_water_id, self.unfinished[0])
+                self.unfinished = None
+
+    def record(self, id, processed, torrent_file_name=None, actual_title=None):
+        with self.lock:
+            if processed:
+                self.pending.remove(id)
+            else:
+                self.pending.add(id, f"{torrent_file_name or ''} {actual_title or ''}")
+
+
+def create_unaccounted_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS unaccounted (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            src_dir TEXT,
+            file_name TEXT,
+            matched_imdb_id TEXT,
+            year TEXT,
+            symlink_top_folder TEXT,
+            symlink_filename TEXT
+        )
+    ''')
+    index = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_unaccounted_src_dir'")
+    if index.fetchone() is None:
+        # Earlier versions appended a row on every pass; keep the newest per folder
+        conn.execute('DELETE FROM unaccounted WHERE id NOT IN (SELECT MAX(id) FROM unaccounted GROUP BY src_dir)')
+        conn.execute('CREATE UNIQUE INDEX idx_unaccounted_src_dir ON unaccounted (src_dir)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_unaccounted_symlink_top_folder ON unaccounted (symlink_top_folder)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS unaccounted_folders (
+            src_dir TEXT PRIMARY KEY,
+            fingerprint TEXT,
+            outcome TEXT,
+            processed_at REAL
+        )
+    ''')
+
+
+def unaccounted_connection():
+    ensure_schema('unaccounted', create_unaccounted_tables)
+    return get_connection()
+
+
+def read_unaccounted_folders(dir_paths=None):
+    conn = unaccounted_connection()
+    if dir_paths is None:
+        rows = conn.execute('SELECT src_dir, fingerprint FROM unaccounted_folders').fetchall()
+    else:
+        dir_paths = list(dir_paths)
+        rows = []
+        for start in range(0, len(dir_paths), 500):
+            chunk = dir_paths[start:start + 500]
+            placeholders = ', '.join('?' for _ in chunk)
+            rows.extend(conn.execute(
+                f'SELECT src_dir, fingerprint FROM unaccounted_folders WHERE src_dir IN ({placeholders})', chunk
+            ).fetchall())
+    return {row['src_dir']: row['fingerprint'] for row in rows}
+
+
+# Batches catalog and unaccounted write-back; writes are only queued once their symlinks exist
+class CatalogWriter:
+    def __init__(self, batch_size=CATALOG_WRITE_BATCH_SIZE, interval=CATALOG_WRITE_INTERVAL):
+        self.lock = threading.Lock()
+        self.batch_size = batch_size
+        self.interval = interval
+        self.catalog_updates = []
+        self.unaccounted_rows = []
+        self.folder_rows = []
+        self.last_flush = time.monotonic()
+
+    def update_catalog_entry(self, processed_dir_name, final_symlink_path, id):
+        with self.lock:
+            self.catalog_updates.append((processed_dir_name, final_symlink_path, id))
+        self.maybe_flush()
+
+    def add_unaccounted(self, src_dir, file_name, matched_imdb_id, year, symlink_top_folder, symlink_filename):
+        with self.lock:
+            self.unaccounted_rows.append((src_dir, file_name, matched_imdb_id, year, symlink_top_folder,
+                                          symlink_filename))
+        self.maybe_flush()
+
+    def record_unaccounted_folder(self, src_dir, fingerprint, outcome):
+        with self.lock:
+            self.folder_rows.append((src_dir, fingerprint, outcome, time.time()))
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        with self.lock:
+            pending = len(self.catalog_updates) + len(self.unaccounted_rows) + len(self.folder_rows)
+            due = pending >= self.batch_size or time.monotonic() - self.last_flush >= self.interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            catalog_updates, self.catalog_updates = self.catalog_updates, []
+            unaccounted_rows, self.unaccounted_rows = self.unaccounted_rows, []
+            folder_rows, self.folder_rows = self.folder_rows, []
+            self.last_flush = time.monotonic()
+        if not (catalog_updates or unaccounted_rows or folder_rows):
+            return
+        conn = unaccounted_connection()
+        try:
+            with conn:
+                conn.executemany('''
+                    UPDATE catalog
+                    SET processed_dir_name = ?, final_symlink_path = ?
+                    WHERE id = ?
+                ''', catalog_updates)
+                conn.executemany('''
+                    INSERT INTO unaccounted (src_dir, file_name, matched_imdb_id, year, symlink_top_folder, symlink_filename)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (src_dir) DO UPDATE SET
+                        file_name = excluded.file_name,
+                        matched_imdb_id = excluded.matched_imdb_id,
+                        year = excluded.year,
+                        symlink_top_folder = excluded.symlink_top_folder,
+                        symlink_filename = excluded.symlink_filename
+                ''', unaccounted_rows)
+                conn.executemany('''
+                    INSERT OR REPLACE INTO unaccounted_folders (src_dir, fingerprint, outcome, processed_at)
+                    VALUES (?, ?, ?, ?)
+                ''', folder_rows)
+        except sqlite3.Error as e:
+            print(f"Error writing catalog updates, will retry: {e}")
+            with self.lock:
+                self.catalog_updates[:0] = catalog_updates
+                self.unaccounted_rows[:0] = unaccounted_rows
+                self.folder_rows[:0] = folder_rows
+            return
+        print(f"Wrote {len(catalog_updates)} catalog updates and {len(unaccounted_rows)} unaccounted folders")
+
+
+catalog_writer = CatalogWriter()
+
 
 def update_catalog_entry(processed_dir_name, final_symlink_path, id):
-    with db_lock:
-        conn = sqlite3.connect(DATABASE_PATH)
-        c = conn.cursor()
-        c.execute('''
-            UPDATE catalog
-            SET processed_dir_name = ?, final_symlink_path = ?
-            WHERE id = ?
-        ''', (processed_dir_name, final_symlink_path, id))
-        conn.commit()
-        conn.close()
+    catalog_writer.update_catalog_entry(processed_dir_name, final_symlink_path, id)
+
+
+def record_unaccounted_folder(src_dir, fingerprint, outcome):
+    catalog_writer.record_unaccounted_folder(src_dir, fingerprint, outcome)
+
+
+# Changes whenever an entry is added to, removed from or renamed in the folder
+def folder_fingerprint(dir_path):
+    try:
+        st = os.stat(dir_path)
+    except OSError:
+        return None
+    return f"{st.st_mtime_ns}:{st.st_nlink}"
 
 
 def extract_year(query):
@@ -61,7 +357,7 @@ def extract_year(query):
     return None
 
 
-def extract_resolution(name, parent_folder_name=None, file_path=None):
+def extract_resolution_from_names(name, parent_folder_name=None):
     resolution_match = re.search(r'(\d{3,4}p)', name, re.IGNORECASE)
     if resolution_match:
         return resolution_match.group(1)
@@ -70,18 +366,27 @@ def extract_resolution(name, parent_folder_name=None, file_path=None):
         resolution_match = re.search(r'(\d{3,4}p)', parent_folder_name, re.IGNORECASE)
         if resolution_match:
             return resolution_match.group(1)
+    return None
+
+
+def prefetch_resolution(name, parent_folder_name=None, file_path=None):
+    # Start probing in the background if extract_resolution will need to
+    if file_path and not extract_resolution_from_names(name, parent_folder_name):
+        probe_pool.submit(file_path)
+
+
+def extract_resolution(name, parent_folder_name=None, file_path=None):
+    resolution = extract_resolution_from_names(name, parent_folder_name)
+    if resolution:
+        return resolution
 
     if file_path:
-        try:
-            clip = VideoFileClip(file_path)
-            width, height = clip.size
-            if width and height:
-                if width in [720, 1080, 2160]:
-                    return f"{width}p"
-                else:
-                    return f"{width}x{height}"
-        except Exception as e:
-            print(f"Error getting resolution with MoviePy: {e}")
+        width, height, _ = probe_pool.probe(file_path)
+        if width and height:
+            if width in [720, 1080, 2160]:
+                return f"{width}p"
+            else:
+                return f"{width}x{height}"
         return None
     return None
 
@@ -108,55 +413,349 @@ def extract_id(eid_string, preferred='imdb', fallback='tmdb'):
     return 'unknown'
 
 
-def find_best_match(torrent_file_name, actual_title, src_dir):
+def normalize_title(name):
+    return ' '.join(sanitize_title(name).lower().split())
+
+
+# Exact and token lookups over keyed names; not thread-safe, SourceIndex guards it
+class NameIndex:
+    def __init__(self):
+        self.texts = {}  # key -> name
+        self.by_sanitized = {}  # sanitized name -> keys
+        self.by_normalized = {}  # normalized name -> keys
+        self.tokens = {}  # key -> normalized tokens
+        self.postings = {}  # token -> keys containing it
+
+    def __len__(self):
+        return len(self.texts)
+
+    def add(self, key, text):
+        if key in self.texts:
+            self.remove(key)
+        self.texts[key] = text
+        self.by_sanitized.setdefault(sanitize_title(text), []).append(key)
+        normalized = normalize_title(text)
+        self.by_normalized.setdefault(normalized, []).append(key)
+        self.tokens[key] = tuple(normalized.split())
+        for token in set(self.tokens[key]):
+            self.postings.setdefault(token, set()).add(key)
+
+    def remove(self, key):
+        text = self.texts.pop(key, None)
+        if text is None:
+            return
+        for name, mapping in ((sanitize_title(text), self.by_sanitized), (normalize_title(text), self.by_normalized)):
+            bucket = mapping.get(name, [])
+            if key in bucket:
+                bucket.remove(key)
+            if not bucket:
+                mapping.pop(name, None)
+        for token in set(self.tokens.pop(key, ())):
+            posting = self.postings.get(token)
+            if posting is not None:
+                posting.discard(key)
+                if not posting:
+                    del self.postings[token]
+
+    def lookup_exact(self, query):
+        if not query:
+            return None
+        for name, mapping in ((sanitize_title(query), self.by_sanitized), (normalize_title(query), self.by_normalized)):
+            bucket = mapping.get(name)
+            if bucket:
+                return bucket[0]
+        return None
+
+    # Up to cap keys sharing the rarest tokens with queries; very common tokens only count if nothing rarer matches
+    def candidates(self, queries, cap=MATCH_CANDIDATE_CAP):
+        tokens = set()
+        for query in queries:
+            if query:
+                tokens.update(normalize_title(query).split())
+
+        total = len(self.texts)
+        if not total:
+            return []
+        max_df = max(cap, total // 20)
+        postings = sorted(
+            (self.postings[token] for token in tokens if token in self.postings),
+            key=len
+        )
+        scores = {}
+        for i, posting in enumerate(postings):
+            if i and len(posting) > max_df:
+                break
+            weight = math.log(total / len(posting)) + 1
+            for key in posting:
+                scores[key] = scores.get(key, 0) + weight
+        return heapq.nlargest(cap, scores, key=scores.get)
+
+
+# Top-level entries of a source directory, plus the largest video file of each directory
+class SourceIndex:
+    def __init__(self, src_dir):
+        self.src_dir = src_dir
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.names = {}  # raw name -> is_dir
+        self.dir_index = NameIndex()
+        self.largest_files = {}  # directory name -> largest video file name, or None
+        self.file_index = NameIndex()  # directory name -> largest video file name sans extension
+        self._snapshot = None
+
+    def refresh(self):
+        listing = {}
+        with os.scandir(self.src_dir) as it:
+            for entry in it:
+                try:
+                    listing[entry.name] = entry.is_dir()
+                except OSError:
+                    listing[entry.name] = False
+
+        with self.lock:
+            added = [name for name in listing if name not in self.names]
+            removed = [name for name in self.names if name not in listing]
+            for name in removed:
+                del self.names[name]
+                self.dir_index.remove(name)
+                self.invalidate(name)
+            for name in added:
+                self.names[name] = listing[name]
+                self.dir_index.add(name, name)
+            if added or removed:
+                self._snapshot = None
+            self.loaded = True
+        if added or removed:
+            print(f"Source index: {len(added)} added, {len(removed)} removed, {len(listing)} total")
+        return added, removed
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            self.refresh()
+
+    # Re-checks only names instead of re-listing the directory
+    def update(self, names):
+        self.ensure_loaded()
+        added, removed = [], []
+        for name in names:
+            if not name:
+                continue
+            path = os.path.join(self.src_dir, name)
+            exists = os.path.lexists(path)
+            is_dir = exists and os.path.isdir(path)
+            with self.lock:
+                if name in self.names and not exists:
+                    del self.names[name]
+                    self.dir_index.remove(name)
+                    removed.append(name)
+                elif exists and name not in self.names:
+                    self.names[name] = is_dir
+                    self.dir_index.add(name, name)
+                    added.append(name)
+                self.invalidate(name)
+                if added or removed:
+                    self._snapshot = None
+        return added, removed
+
+    def invalidate(self, name):
+        with self.lock:
+            self.largest_files.pop(name, None)
+            self.file_index.remove(name)
+
+    def directories(self):
+        with self.lock:
+            return [name for name, is_dir in self.names.items() if is_dir]
+
+    def lookup_exact(self, query):
+        if not query:
+            return None
+        with self.lock:
+            if query in self.names:
+                return query
+            return self.dir_index.lookup_exact(query)
+
+    def candidates(self, queries, cap=MATCH_CANDIDATE_CAP):
+        with self.lock:
+            return self.dir_index.candidates(queries, cap)
+
+    def snapshot(self):
+        with self.lock:
+            if self._snapshot is None:
+                self._snapshot = (list(self.names), {key: names[0] for key, names in self.dir_index.by_sanitized.items()})
+            return self._snapshot
+
+    def ensure_largest_files(self):
+        with self.lock:
+            missing = [name for name, is_dir in self.names.items() if is_dir and name not in self.largest_files]
+        if not missing:
+            return
+        print(f"Scanning {len(missing)} source directories for their largest video file")
+        scanned = {name: largest_video_file(os.path.join(self.src_dir, name)) for name in missing}
+        with self.lock:
+            for name, largest_file in scanned.items():
+                if name not in self.names:
+                    continue
+                self.largest_files[name] = largest_file
+                if largest_file:
+                    self.file_index.add(name, strip_extension(largest_file))
+
+    # From a saved snapshot instead of scanning
+    def seed_largest_files(self, largest_files):
+        self.ensure_loaded()
+        with self.lock:
+            for name, largest_file in largest_files.items():
+                if not self.names.get(name) or name in self.largest_files:
+                    continue
+                self.largest_files[name] = largest_file
+                if largest_file:
+                    self.file_index.add(name, strip_extension(largest_file))
+
+    def match_largest_file(self, queries, blocking=MATCH_BLOCKING):
+        self.ensure_largest_files()
+        with self.lock:
+            for query in queries:
+                exact = self.file_index.lookup_exact(query)
+                if exact:
+                    return exact
+            keys = self.file_index.candidates(queries) if blocking else list(self.file_index.texts)
+            files = [self.largest_files[key] for key in keys]
+        match = engine.first_match(queries, files, DIRECTORY_MATCH_THRESHOLD)
+        return keys[match[1]] if match else None
+
+
+VIDEO_EXTENSIONS = {'.mkv', '.mp4', '.avi', '.m4v', '.mov', '.wmv', '.ts', '.m2ts', '.webm', '.mpg', '.mpeg', '.flv'}
+
+
+# One scandir per source directory per pass, shared by the matcher and both branches
+class DirectoryScanner:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.listings = {}  # directory -> [(name, file size, None for anything but files)]
+
+    def clear(self):
+        with self.lock:
+            self.listings = {}
+
+    # Raises OSError like os.listdir
+    def entries(self, directory):
+        with self.lock:
+            listing = self.listings.get(directory)
+        if listing is None:
+            listing = []
+            with os.scandir(directory) as it:
+                for entry in it:
+                    try:
+                        size = entry.stat().st_size if entry.is_file() else None
+                    except OSError:
+                        size = None
+                    listing.append((entry.name, size))
+            with self.lock:
+                self.listings[directory] = listing
+        return listing
+
+    def files(self, directory):
+        return [(name, size) for name, size in self.entries(directory) if size is not None]
+
+    def largest_file(self, directory, extensions=None):
+        largest_file = None
+        largest_size = 0
+        for name, size in self.files(directory):
+            if extensions is not None and os.path.splitext(name)[1].lower() not in extensions:
+                continue
+            if size > largest_size:
+                largest_size = size
+                largest_file = name
+        return largest_file
+
+
+scanner = DirectoryScanner()
+
+
+def largest_video_file(directory):
     try:
-        dirs = os.listdir(src_dir)
-        sanitized_dirs = {sanitize_title(d): d for d in dirs}
+        return scanner.largest_file(directory, VIDEO_EXTENSIONS)
+    except OSError as e:
+        print(f"Error scanning {directory}: {e}")
+        return None
+
+
+catalog_queue = CatalogWorkQueue()
+_source_indexes = {}
+
+
+def get_source_index(src_dir):
+    index = _source_indexes.get(src_dir)
+    if index is None:
+        index = _source_indexes[src_dir] = SourceIndex(src_dir)
+    return index
 
-        def get_largest_file(directory):
-            largest_file = None
-            largest_size = 0
-            for file_name in os.listdir(directory):
-                file_path = os.path.join(directory, file_name)
-                if os.path.isfile(file_path):
-                    file_size = os.path.getsize(file_path)
-                    if file_size > largest_size:
-                        largest_size = file_size
-                        largest_file = file_name
-            return largest_file
 
+def find_best_match(torrent_file_name, actual_title, src_dir, index=None, blocking=MATCH_BLOCKING):
+    try:
+        if index is None:
+            index = get_source_index(src_dir)
+        index.ensure_loaded()
+
+        for query in (torrent_file_name, actual_title):
+            exact = index.lookup_exact(query)
+            if exact:
+                return os.path.join(src_dir, exact)
+
+        if blocking:
+            dirs = index.candidates((torrent_file_name, actual_title))
+            sanitized_dirs = {}
+            for d in dirs:
+                sanitized_dirs.setdefault(sanitize_title(d), d)
+        else:
+            dirs, sanitized_dirs = index.snapshot()
+
+        # Same six attempts as before, scored as two batched calls
         attempts = [
-            (torrent_file_name, dirs),
-            (actual_title, dirs),
-            (sanitize_title(torrent_file_name), dirs),
-            (sanitize_title(actual_title), dirs),
-            (sanitize_title(torrent_file_name), sanitized_dirs.keys()),
-            (sanitize_title(actual_title), sanitized_dirs.keys())
+            ([torrent_file_name, actual_title, sanitize_title(torrent_file_name), sanitize_title(actual_title)], dirs),
+            ([sanitize_title(torrent_file_name), sanitize_title(actual_title)], list(sanitized_dirs))
         ]
 
-        for query, candidates in attempts:
-            best_match, score = process.extractOne(query, candidates, scorer=fuzz.ratio)
-            if score >= 90:
+        for queries, candidates in attempts:
+            match = engine.first_match(queries, candidates, DIRECTORY_MATCH_THRESHOLD)
+            if match:
+                best_match = candidates[match[1]]
                 return os.path.join(src_dir, sanitized_dirs.get(best_match, best_match))
 
-        for directory in dirs:
-            dir_path = os.path.join(src_dir, directory)
-            if os.path.isdir(dir_path):
-                largest_file = get_largest_file(dir_path)
-                if largest_file:
-                    best_match, score = process.extractOne(torrent_file_name, [largest_file], scorer=fuzz.ratio)
-                    if score >= 90:
-                        return dir_path
-
-                    best_match, score = process.extractOne(actual_title, [largest_file], scorer=fuzz.ratio)
-                    if score >= 90:
-                        return dir_path
+        directory = index.match_largest_file([torrent_file_name, actual_title], blocking=blocking)
+        if directory:
+            return os.path.join(src_dir, directory)
 
     except Exception as e:
         print(f"Error finding best match: {e}")
     return None
 
 
+# Fraction of brute-force matches the blocked matcher reproduces; prints every miss
+def check_blocking_recall(src_dir, limit=None):
+    index = get_source_index(src_dir)
+    index.refresh()
+    rows = iter_catalog_rows()
+    if limit:
+        rows = itertools.islice(rows, limit)
+
+    expected = agreed = 0
+    for entry in rows:
+        torrent_file_name, actual_title = entry['torrent_file_name'], entry['actual_title']
+        brute = find_best_match(torrent_file_name, actual_title, src_dir, index=index, blocking=False)
+        if not brute:
+            continue
+        expected += 1
+        blocked = find_best_match(torrent_file_name, actual_title, src_dir, index=index, blocking=True)
+        if blocked == brute:
+            agreed += 1
+        else:
+            print(f"Recall miss for '{torrent_file_name}': brute-force {brute}, blocked {blocked}")
+
+    recall = agreed / expected if expected else 1.0
+    print(f"Blocking recall: {agreed}/{expected} ({recall:.1%}) with candidate cap {MATCH_CANDIDATE_CAP}")
+    return recall
+
+
 def extract_season_episode(file_name):
     patterns = [
         r'[Ss](\d{1,2})[Ee](\d{1,2})',
@@ -175,175 +774,411 @@ def extract_season_episode(file_name):
     return None, None
 
 
+# Episodes already linked under each show folder, listed once per pass
+class EpisodeIndex:
+    EPISODE_PATTERN = re.compile(r' - (S\d+E\d+) \[')
+
+    def __init__(self):
+        self.shows = {}  # show folder -> season folder -> episode identifier -> {file name: path}
+
+    def _load(self, show_folder):
+        seasons = {}
+        try:
+            with os.scandir(show_folder) as it:
+                season_dirs = [entry for entry in it if entry.is_dir()]
+        except FileNotFoundError:
+            season_dirs = []
+        for season_dir in season_dirs:
+            episodes = seasons[season_dir.name] = {}
+            with os.scandir(season_dir.path) as it:
+                for entry in it:
+                    match = self.EPISODE_PATTERN.search(entry.name)
+                    if match:
+                        episodes.setdefault(match.group(1), {})[entry.name] = entry.path
+        return seasons
+
+    # None if the season folder does not exist
+    def season(self, show_folder, season_folder):
+        if show_folder not in self.shows:
+            self.shows[show_folder] = self._load(show_folder)
+        return self.shows[show_folder].get(season_folder)
+
+    def find(self, show_folder, season_folder, episode_identifier, prefix, file_ext):
+        episodes = self.season(show_folder, season_folder) or {}
+        for file_name, path in episodes.get(episode_identifier, {}).items():
+            if file_name.startswith(prefix) and file_name.endswith(file_ext):
+                return path
+        return None
+
+    def add_season(self, show_folder, season_folder):
+        episodes = self.season(show_folder, season_folder)
+        if episodes is None:
+            episodes = self.shows[show_folder][season_folder] = {}
+        return episodes
+
+    def add(self, show_folder, season_folder, episode_identifier, file_name):
+        path = os.path.join(show_folder, season_folder, file_name)
+        self.add_season(show_folder, season_folder).setdefault(episode_identifier, {})[file_name] = path
+
+
 def strip_extension(name):
     return re.sub(r'\.\w{2,4}$', '', name)  # Removes common file extensions (e.g., .mp4, .mkv, .avi)
 
 
-def create_symlinks_from_catalog(src_dir, dest_dir, dest_dir_movies, catalog_path):
-    catalog_data = read_catalog_db()
-
-    for entry in catalog_data:
-        if not entry[15]:
+# Applies planned links in batches; with plan_output they are written as JSON Lines instead
+class SymlinkWriter:
+    def __init__(self, batch_size=SYMLINK_BATCH_SIZE, atomic=SYMLINK_ATOMIC, plan_output=None):
+        self.batch_size = batch_size
+        self.atomic = atomic
+        self.plan_output = plan_output
+        self.groups = []  # ([(source, destination)], on_done, info)
+        self.pending_links = 0
+        self.counts = {'planned': 0, 'created': 0, 'skipped': 0, 'failed': 0}
+
+    def add(self, links, on_done=None, info=None):
+        self.groups.append((links, on_done, info))
+        self.pending_links += len(links)
+        self.counts['planned'] += len(links)
+
+    def due(self):
+        return self.pending_links >= self.batch_size
+
+    # None for folders that cannot be listed or created
+    def _list_folders(self, folders):
+        existing = {}
+        for folder in sorted(folders):
             try:
-                id = entry[0]
-                eid = entry[1]
-                title = entry[2]
-                type_ = entry[3]
-                year = entry[4]
-                parent_eid = entry[5]
-                parent_title = entry[6]
-                parent_type = entry[7]
-                parent_year = entry[8]
-                grandparent_eid = entry[9]
-                grandparent_title = entry[10]
-                grandparent_type = entry[11]
-                grandparent_year = entry[12]
-                torrent_file_name = entry[13]
-                catalog_torrent_file_name = entry[13]
-                actual_title = entry[14]
-                catalog_actual_title = entry[14]
-                processed_dir_name = entry[15]
-                final_symlink_path = entry[16]
-
-                if type_ == 'movie':
-                    base_title = title
-                    base_year = year
-                    imdb_id = extract_id(entry[1]) if entry[1] else 'unknown'
-                    if f"({base_year})" in base_title:
-                        folder_name = f"{base_title} {{imdb-{imdb_id}}}"
-                    else:
-                        folder_name = f"{base_title} ({base_year}) {{imdb-{imdb_id}}}"
-                    target_folder = os.path.join(dest_dir_movies, folder_name)
-
-                    if not os.path.exists(target_folder):
-                        os.makedirs(target_folder, exist_ok=True)
-                        print(f"Created target folder: {target_folder}")
-
-                    torrent_dir_path = find_best_match(torrent_file_name, actual_title, src_dir)
-                    if not torrent_dir_path:
-                        continue
-                    print(f"Processing torrent directory: {torrent_dir_path}")
-
-                    largest_file = None
-                    largest_size = 0
-                    for file_name in os.listdir(torrent_dir_path):
-                        file_path = os.path.join(torrent_dir_path, file_name)
-                        if os.path.isfile(file_path):
-                            file_size = os.path.getsize(file_path)
-                            if file_size > largest_size:
-                                largest_size = file_size
-                                largest_file = file_name
-
-                    if largest_file:
-                        file_ext = os.path.splitext(largest_file)[1]
-                        resolution = extract_resolution(largest_file, parent_folder_name=torrent_dir_path, file_path=os.path.join(torrent_dir_path, largest_file))
-                        target_file_name = f"{base_title}  ({base_year}) {{imdb-{imdb_id}}} [{resolution}]{file_ext}"
-                        target_file_name = clean_filename(target_file_name)
-                        target_file_path = os.path.join(target_folder, target_file_name)
-
-                        largest_file_path = os.path.join(torrent_dir_path, largest_file)
-                        if not os.path.exists(target_file_path):
-                            try:
-                                relative_source_path = os.path.relpath(largest_file_path, os.path.dirname(target_file_path))
-                                os.symlink(relative_source_path, target_file_path)
-                                print(f"Created relative symlink: {target_file_path} -> {relative_source_path}")
-                            except OSError as e:
-                                print(f"Error creating relative symlink: {e}")
-                                target_folder = None
-
-                        else:
-                            print(f"Symlink already exists: {target_file_path}")
-
+                with os.scandir(folder) as it:
+                    existing[folder] = {entry.name for entry in it}
+            except FileNotFoundError:
+                if self.plan_output is not None:
+                    existing[folder] = set()
+                    continue
+                try:
+                    os.makedirs(folder, exist_ok=True)
+                    print(f"Created target folder: {folder}")
+                    existing[folder] = set()
+                except OSError as e:
+                    print(f"Error creating target folder: {e}")
+                    existing[folder] = None
+            except OSError as e:
+                print(f"Error listing target folder {folder}: {e}")
+                existing[folder] = None
+        return existing
+
+    def _link(self, source, destination):
+        relative_source_path = os.path.relpath(source, os.path.dirname(destination))
+        if self.atomic:
+            temp_path = os.path.join(os.path.dirname(destination), f".{os.path.basename(destination)}.{os.getpid()}.tmp")
+            os.symlink(relative_source_path, temp_path)
+            try:
+                os.replace(temp_path, destination)
+            except OSError:
+                os.unlink(temp_path)
+                raise
+        else:
+            os.symlink(relative_source_path, destination)
+        print(f"Created relative symlink: {destination} -> {relative_source_path}")
+
+    def apply(self):
+        groups, self.groups = self.groups, []
+        self.pending_links = 0
+        existing = self._list_folders({os.path.dirname(destination) for links, _, _ in groups for _, destination in links})
+        for links, on_done, info in groups:
+            if self.plan_output is not None:
+                self._write_plan(links, info, existing)
+                continue
+            linked = True
+            for source, destination in links:
+                folder, name = os.path.split(destination)
+                names = existing[folder]
+                if names is None:
+                    self.counts['failed'] += 1
+                    linked = False
+                elif name in names:
+                    print(f"Symlink already exists: {destination}")
+                    self.counts['skipped'] += 1
                 else:
-                    base_title = grandparent_title if grandparent_title else parent_title if parent_title else title
-                    base_year = grandparent_year if grandparent_year else parent_year if parent_year else year
-                    imdb_id = extract_id(entry[9]) if entry[9] else extract_id(entry[5]) if entry[5] else extract_id(entry[1]) if entry[1] else 'unknown'
-
-                    if f"({base_year})" in base_title:
-                        folder_name = f"{base_title} {{imdb-{imdb_id}}}"
-                    else:
-                        folder_name = f"{base_title} ({base_year}) {{imdb-{imdb_id}}}"
-                    target_folder = os.path.join(dest_dir, folder_name)
-
-                    if not os.path.exists(target_folder):
-                        try:
-                            os.makedirs(target_folder)
-                            print(f"Created target folder: {target_folder}")
-                        except OSError as e:
-                            print(f"Error creating target folder: {e}")
-                            continue
-
-                    torrent_dir_path = find_best_match(torrent_file_name, actual_title, src_dir)
-                    if not torrent_dir_path:
-                        continue
-                    print(f"Processing torrent directory: {torrent_dir_path}")
-
-                    for file_name in os.listdir(torrent_dir_path):
-                        file_path = os.path.join(torrent_dir_path, file_name)
-                        print(f"Processing file: {file_path}")
-
-                        if os.path.isfile(file_path):
-                            file_ext = os.path.splitext(file_name)[1]
-
-                            season, episode = extract_season_episode(file_name)
-                            if not (season and episode):
-                                continue
-
-                            season_folder = f"Season {season}"
-                            episode_identifier = f"S{season}E{episode}"
-
-                            target_folder_season = os.path.join(target_folder, season_folder)
-                            existing_files = os.listdir(target_folder_season) if os.path.exists(target_folder_season) else []
-                            episode_pattern = f"{base_title} ({base_year}) {{imdb-{imdb_id}}} - {episode_identifier} ["
-                            if any(f.startswith(episode_pattern) and f.endswith(file_ext) for f in existing_files):
-                                print(f"Symlink for {episode_identifier} already exists. Skipping file: {file_name}")
-                                continue
-
-                            resolution = extract_resolution(file_name, parent_folder_name=torrent_dir_path, file_path=file_path)
-                            target_file_name = f"{base_title} ({base_year}) {{imdb-{imdb_id}}} - {episode_identifier} [{resolution}]{file_ext}"
-                            target_file_name = clean_filename(target_file_name)
-
-                            if not os.path.exists(target_folder_season):
-                                os.makedirs(target_folder_season, exist_ok=True)
-
-                            target_file_path = os.path.join(target_folder_season, target_file_name)
-
-                            if not os.path.exists(file_path):
-                                print(f"Source file does not exist: {file_path}")
-                            elif not os.path.exists(target_file_path):
-                                try:
-                                    relative_source_path = os.path.relpath(file_path, os.path.dirname(target_file_path))
-                                    os.symlink(relative_source_path, target_file_path)
-                                    print(f"Created relative symlink: {target_file_path} -> {relative_source_path}")
-
-                                except OSError as e:
-                                    print(f"Error creating relative symlink: {e}")
-                                    target_folder = None
-                if target_folder:
-                    update_catalog_entry(torrent_dir_path, target_folder, id)
+                    try:
+                        self._link(source, destination)
+                        names.add(name)
+                        self.counts['created'] += 1
+                    except OSError as e:
+                        print(f"Error creating relative symlink: {e}")
+                        self.counts['failed'] += 1
+                        linked = False
+            if on_done is not None:
+                on_done(linked)
+
+    def _write_plan(self, links, info, existing):
+        for source, destination in links:
+            folder, name = os.path.split(destination)
+            exists = existing[folder] is not None and name in existing[folder]
+            self.counts['skipped' if exists else 'created'] += 1
+            if not exists and existing[folder] is not None:
+                existing[folder].add(name)
+            record = dict(info or {}, source=source, destination=destination,
+                          target=os.path.relpath(source, folder), exists=exists)
+            self.plan_output.write(json.dumps(record) + '\n')
+
+    def report(self):
+        prefix = "Dry run symlinks" if self.plan_output is not None else "Symlinks"
+        print(f"{prefix}: " + "{planned} planned, {created} created, {skipped} skipped, {failed} failed".format(**self.counts))
+
+
+def target_folder_name(base_title, base_year, imdb_id):
+    if f"({base_year})" in base_title:
+        return f"{base_title} {{imdb-{imdb_id}}}"
+    return f"{base_title} ({base_year}) {{imdb-{imdb_id}}}"
+
+
+def match_torrent_dir(entry, src_dir, index):
+    return entry['processed_dir_name'] or find_best_match(entry['torrent_file_name'], entry['actual_title'], src_dir,
+                                                          index=index)
+
+
+def prefetch_movie(entry, src_dir, index):
+    # Matches the entry and starts probing its largest file; returns the match for plan_movie_links
+    torrent_dir_path = match_torrent_dir(entry, src_dir, index)
+    if torrent_dir_path:
+        try:
+            largest_file = scanner.largest_file(torrent_dir_path)
+        except OSError:
+            largest_file = None
+        if largest_file:
+            prefetch_resolution(largest_file, parent_folder_name=torrent_dir_path,
+                                file_path=os.path.join(torrent_dir_path, largest_file))
+    return torrent_dir_path
 
-            except Exception as e:
-                print(f"Error processing entry: {e}")
 
-    processed_dir_names = {os.path.basename(entry[15]) for entry in catalog_data if entry[15]}
-    src_directories = [d for d in os.listdir(src_dir) if os.path.isdir(os.path.join(src_dir, d))]
-    unprocessed_directories = set(src_directories) - processed_dir_names
-    print(f"Unprocessed {unprocessed_directories}")
+# Returns (torrent_dir_path, target_folder, [(source, destination)]), or None if unmatched
+def plan_movie_links(entry, torrent_dir_path, dest_dir_movies):
+    base_title = entry['title']
+    base_year = entry['year']
+    imdb_id = extract_id(entry['eid']) if entry['eid'] else 'unknown'
+    target_folder = os.path.join(dest_dir_movies, target_folder_name(base_title, base_year, imdb_id))
 
-    for dir_name in unprocessed_directories:
-        dir_path = os.path.join(src_dir, dir_name)
-        print(f"Processing unaccounted folder: {dir_path}")
-        process_unaccounted_folder(dir_path, DEST_DIR)
+    if not torrent_dir_path:
+        return None
+    print(f"Processing torrent directory: {torrent_dir_path}")
 
+    planned = []
+    largest_file = scanner.largest_file(torrent_dir_path)
+    if largest_file:
+        file_ext = os.path.splitext(largest_file)[1]
+        resolution = extract_resolution(largest_file, parent_folder_name=torrent_dir_path, file_path=os.path.join(torrent_dir_path, largest_file))
+        target_file_name = f"{base_title}  ({base_year}) {{imdb-{imdb_id}}} [{resolution}]{file_ext}"
+        target_file_name = clean_filename(target_file_name)
+        planned.append((os.path.join(torrent_dir_path, largest_file), os.path.join(target_folder, target_file_name)))
+    return torrent_dir_path, target_folder, planned
+
+
+# Episodes already linked are left out unless include_existing
+def plan_show_links(entry, src_dir, dest_dir, index, episode_index, include_existing=False):
+    base_title = entry['grandparent_title'] or entry['parent_title'] or entry['title']
+    base_year = entry['grandparent_year'] or entry['parent_year'] or entry['year']
+    imdb_id = (extract_id(entry['grandparent_eid']) if entry['grandparent_eid'] else
+               extract_id(entry['parent_eid']) if entry['parent_eid'] else
+               extract_id(entry['eid']) if entry['eid'] else 'unknown')
+    target_folder = os.path.join(dest_dir, target_folder_name(base_title, base_year, imdb_id))
 
-def create_symlinks():
+    torrent_dir_path = match_torrent_dir(entry, src_dir, index)
+    if not torrent_dir_path:
+        return None
+    print(f"Processing torrent directory: {torrent_dir_path}")
+
+    entries = scanner.entries(torrent_dir_path)
+    for file_name, size in entries:
+        if size is not None and extract_season_episode(file_name)[1]:
+            prefetch_resolution(file_name, parent_folder_name=torrent_dir_path,
+                                file_path=os.path.join(torrent_dir_path, file_name))
+
+    planned = []
+    for file_name, size in entries:
+        file_path = os.path.join(torrent_dir_path, file_name)
+        print(f"Processing file: {file_path}")
+        if size is None:
+            continue
+
+        file_ext = os.path.splitext(file_name)[1]
+        season, episode = extract_season_episode(file_name)
+        if not (season and episode):
+            continue
+
+        season_folder = f"Season {season}"
+        episode_identifier = f"S{season}E{episode}"
+        episode_pattern = f"{base_title} ({base_year}) {{imdb-{imdb_id}}} - {episode_identifier} ["
+        existing_path = episode_index.find(target_folder, season_folder, episode_identifier, episode_pattern, file_ext)
+        if existing_path:
+            print(f"Symlink for {episode_identifier} already exists. Skipping file: {file_name}")
+            if include_existing:
+                planned.append((file_path, existing_path))
+            continue
+
+        resolution = extract_resolution(file_name, parent_folder_name=torrent_dir_path, file_path=file_path)
+        target_file_name = f"{base_title} ({base_year}) {{imdb-{imdb_id}}} - {episode_identifier} [{resolution}]{file_ext}"
+        target_file_name = clean_filename(target_file_name)
+        planned.append((file_path, os.path.join(target_folder, season_folder, target_file_name)))
+        # Later files for the same episode in this pass are skipped like existing ones
+        episode_index.add(target_folder, season_folder, episode_identifier, target_file_name)
+    return torrent_dir_path, target_folder, planned
+
+
+def finish_catalog_entry(id, torrent_file_name, actual_title, torrent_dir_path, target_folder, linked):
+    if linked:
+        update_catalog_entry(torrent_dir_path, target_folder, id)
+    catalog_queue.record(id, linked, torrent_file_name, actual_title)
+
+
+def create_symlinks_from_catalog(src_dir, dest_dir, dest_dir_movies, catalog_path, full_scan=False, touched_dirs=None,
+                                 plan_output=None):
+    dry_run = plan_output is not None
+    # Source listings are only trusted for the length of one pass
+    scanner.clear()
+    index = get_source_index(src_dir)
+    if touched_dirs is None or full_scan or not INCREMENTAL_CATALOG:
+        touched_dirs = None
+        added, _ = index.refresh()
+        if added:
+            catalog_queue.mark_dirty()
+        src_directories = index.directories()
+    else:
+        # Only the directories named by the monitor are looked at
+        index.update(touched_dirs)
+        src_directories = [d for d in touched_dirs if index.names.get(d)]
+        print(f"Targeted pass for {len(touched_dirs)} touched directories")
+
+    if dry_run:
+        touched_dirs = None
+        catalog_data = iter_catalog_rows()
+    elif not INCREMENTAL_CATALOG:
+        catalog_data = iter_unprocessed_catalog_rows()
+    else:
+        if full_scan:
+            catalog_queue.reset()
+        catalog_data = catalog_queue.collect(touched_dirs)
+
+    # Rows already linked to a touched directory are re-run so new files get linked
+    relink_rows = read_catalog_rows_by_processed_dir(os.path.join(src_dir, d) for d in src_directories) if touched_dirs else ()
+    catalog_data = itertools.chain(((entry, False) for entry in catalog_data), ((entry, True) for entry in relink_rows))
+    episode_index = EpisodeIndex()
+    links = SymlinkWriter(plan_output=plan_output)
+    planned_dirs = set()
+
+    while True:
+        window = list(itertools.islice(catalog_data, CATALOG_PREFETCH))
+        if not window:
+            break
+        window = [(entry, relink) for entry, relink in window
+                  if relink or dry_run or not entry['processed_dir_name']]
+        # Match the movies in the window first, so their probes run while earlier entries are linked
+        matches = {}
+        for entry, _ in window:
+            if entry['type'] == 'movie' and entry['id'] not in matches:
+                try:
+                    matches[entry['id']] = prefetch_movie(entry, src_dir, index)
+                except Exception as e:
+                    print(f"Error matching entry: {e}")
+
+        for entry, _ in window:
+            plan = None
+            try:
+                if entry['type'] == 'movie':
+                    torrent_dir_path = (matches[entry['id']] if entry['id'] in matches else
+                                        match_torrent_dir(entry, src_dir, index))
+                    plan = plan_movie_links(entry, torrent_dir_path, dest_dir_movies)
+                else:
+                    plan = plan_show_links(entry, src_dir, dest_dir, index, episode_index, include_existing=dry_run)
+            except Exception as e:
+                print(f"Error processing entry: {e}")
+            if plan is None:
+                if not dry_run:
+                    catalog_queue.record(entry['id'], False, entry['torrent_file_name'], entry['actual_title'])
+                continue
+            torrent_dir_path, target_folder, planned = plan
+            planned_dirs.add(os.path.basename(torrent_dir_path))
+            links.add(planned, functools.partial(finish_catalog_entry, entry['id'], entry['torrent_file_name'],
+                                                 entry['actual_title'], torrent_dir_path, target_folder),
+                      info={'catalog_id': entry['id'], 'type': entry['type'], 'torrent_dir': torrent_dir_path})
+            if links.due():
+                links.apply()
+    links.apply()
+    if not dry_run and INCREMENTAL_CATALOG:
+        catalog_queue.finish()
+
+    # The unaccounted folders are worked out from the catalog, so it has to be up to date
+    catalog_writer.flush()
+    # A targeted pass only needs the records of the directories it looks at
+    dir_paths = [os.path.join(src_dir, d) for d in src_directories] if touched_dirs is not None else None
+    processed_dir_names = read_processed_dir_names(dir_paths)
+    # A dry run writes nothing back, so its own matches have to be excluded here
+    recorded_folders = read_unaccounted_folders(dir_paths) if not dry_run else {}
+    if dry_run:
+        processed_dir_names |= planned_dirs
+    unprocessed_directories = []
+    for dir_name in set(src_directories) - processed_dir_names:
+        dir_path = os.path.join(src_dir, dir_name)
+        fingerprint = folder_fingerprint(dir_path)
+        # Folders handled before are skipped until their contents change
+        if fingerprint is not None and recorded_folders.get(dir_path) != fingerprint:
+            unprocessed_directories.append((dir_name, fingerprint))
+    print(f"Unprocessed {[dir_name for dir_name, _ in unprocessed_directories]}")
+
+    # Probe and look up the likely movie folders in the background while they are processed in order
+    for dir_name, _ in unprocessed_directories:
+        dir_path = os.path.join(src_dir, dir_name)
+        try:
+            largest_file = find_largest_file(dir_path)
+        except OSError as e:
+            print(f"Error scanning {dir_path}: {e}")
+            continue
+        if largest_file and not extract_season_episode(largest_file)[1]:
+            prefetch_resolution(largest_file, parent_folder_name=dir_name, file_path=os.path.join(dir_path, largest_file))
+            year = extract_year(dir_name) or extract_year(largest_file)
+            resolution = extract_resolution_from_names(largest_file, dir_name)
+            cinemeta_client.submit_movie_info(clean_title_for_search(dir_name, year, resolution), year)
+
+    for dir_name, fingerprint in unprocessed_directories:
+        dir_path = os.path.join(src_dir, dir_name)
+        print(f"Processing unaccounted folder: {dir_path}")
+        try:
+            # Movie folders are recorded as handled by their link callback, once the link exists
+            outcome = process_unaccounted_folder(dir_path, DEST_DIR, links, fingerprint=fingerprint)
+        except OSError as e:
+            print(f"Error processing unaccounted folder {dir_path}: {e}")
+            continue
+        if outcome in ("tv_show", "no_files") and not dry_run:
+            record_unaccounted_folder(dir_path, fingerprint, outcome)
+        if links.due():
+            links.apply()
+    links.apply()
+    links.report()
+
+
+def create_symlinks(full_scan=False, touched_dirs=None):
     try:
-        create_symlinks_from_catalog(src_dir, dest_dir, dest_dir_movies, DATABASE_PATH)
+        create_symlinks_from_catalog(src_dir, dest_dir, dest_dir_movies, DATABASE_PATH, full_scan=full_scan,
+                                     touched_dirs=touched_dirs)
     except Exception as e:
         print(f"Error in create_symlinks: {e}")
+    finally:
+        catalog_writer.flush()
+        scanner.clear()
     print("create_symlinks function completed.")
 
 
+# Dry run over everything, writing the link plan to plan_output
+def plan_symlinks(plan_output):
+    started = time.monotonic()
+    set_read_only()
+    try:
+        create_symlinks_from_catalog(src_dir, dest_dir, dest_dir_movies, DATABASE_PATH, plan_output=plan_output)
+    finally:
+        scanner.clear()
+        set_read_only(False)
+    print(f"Planned the library in {time.monotonic() - started:.1f}s")
+
+
 def is_tv_show(folder_name):
     tv_show_patterns = [
         r'[Ss](\d{1,2})[Ee](\d{1,2})',  # S01E01 or similar
@@ -361,26 +1196,16 @@ def is_tv_show(folder_name):
 
 
 def check_files_for_tv_show(folder_path):
-    for file_name in os.listdir(folder_path):
-        if os.path.isfile(os.path.join(folder_path, file_name)):
-            season, episode = extract_season_episode(file_name)
-            if season and episode:
-                print(f"Detected season/episode pattern in file: {file_name}")
-                return True
+    for file_name, _ in scanner.files(folder_path):
+        season, episode = extract_season_episode(file_name)
+        if season and episode:
+            print(f"Detected season/episode pattern in file: {file_name}")
+            return True
     return False
 
 
 def find_largest_file(folder_path):
-    largest_file = None
-    largest_size = 0
-    for file_name in os.listdir(folder_path):
-        file_path = os.path.join(folder_path, file_name)
-        if os.path.isfile(file_path):
-            file_size = os.path.getsize(file_path)
-            if file_size > largest_size:
-                largest_size = file_size
-                largest_file = file_name
-    return largest_file
+    return scanner.largest_file(folder_path)
 
 
 def extract_year_from_folder_and_file(folder_name, largest_file):
@@ -400,53 +1225,8 @@ def extract_year_from_folder_and_file(folder_name, largest_file):
     return None
 
 
-_api_cache = {}
-
-
 def get_movie_info(title, year=None):
-    global _api_cache
-    formatted_title = title.replace(" ", "%20")
-    cache_key = f"movie_{formatted_title}_{year}"
-
-    if cache_key in _api_cache:
-        return _api_cache[cache_key]
-
-    url = f"https://v3-cinemeta.strem.io/catalog/movie/top/search={formatted_title}.json"
-    try:
-        response = requests.get(url)
-        if response.status_code != 200:
-            print(f"Error fetching movie information: HTTP {response.status_code}")
-            return title
-
-        movie_data = response.json()
-
-        if 'metas' in movie_data and movie_data['metas']:
-            movie_options = movie_data['metas']
-            best_match = None
-            highest_score = 0
-
-            for movie_info in movie_options:
-                imdb_id = movie_info.get('imdb_id')
-                movie_title = movie_info.get('name')
-                year_info = movie_info.get('releaseInfo')
-
-                # Use stricter matching criteria
-                score = fuzz.ratio(title.lower().strip(), movie_title.lower().strip())
-                if score > highest_score:
-                    highest_score = score
-                    best_match = f"{movie_title} ({year_info}) {{imdb-{imdb_id}}}"
-
-            # Reject outright if the best match score is too low
-            if highest_score >= 80:  # Adjust this threshold as needed
-                _api_cache[cache_key] = best_match
-                return best_match
-            else:
-                print(f"Rejected match for '{title}' with best score {highest_score}. Returning original title.")
-                return title
-
-    except requests.RequestException as e:
-        print(f"Error fetching movie information: {e}")
-        return f'{title} {year}'
+    return cinemeta_client.movie_info(title, year)
 
 
 def clean_title_for_search(title, year, resolution):
@@ -475,7 +1255,16 @@ def clean_title_for_search(title, year, resolution):
     return title
 
 
-def process_unaccounted_folder(folder_path, dest_dir):
+def finish_unaccounted_folder(folder_path, file_name, imdb_id, year, target_folder, target_file_name, fingerprint,
+                              linked):
+    if not linked:
+        return
+    catalog_writer.add_unaccounted(folder_path, file_name, imdb_id, year, target_folder, target_file_name)
+    if fingerprint is not None:
+        record_unaccounted_folder(folder_path, fingerprint, "movie")
+
+
+def process_unaccounted_folder(folder_path, dest_dir, links=None, fingerprint=None):
     folder_name = os.path.basename(folder_path)
 
     # Check if the folder is a TV show first
@@ -505,7 +1294,11 @@ def process_unaccounted_folder(folder_path, dest_dir):
     cleaned_title = clean_title_for_search(folder_name, year, resolution)
 
     # Fetch the proper movie name using the API
-    movie_name = get_movie_info(cleaned_title, year=year)
+    status, movie_name = get_movie_info(cleaned_title, year=year)
+    if status == ERROR:
+        # Linking under the search title would leave a stray folder once the lookup works again
+        print(f"Cinemeta lookup failed for '{cleaned_title}', will retry on a later pass")
+        return "lookup_error"
     print(f"Identified movie: {movie_name}")
 
     # Handle cases where IMDb ID might not be extracted correctly
@@ -514,14 +1307,9 @@ def process_unaccounted_folder(folder_path, dest_dir):
         print(f"Error extracting IMDb ID from movie name: {movie_name}")
 
     try:
-        # Create target folder for the movie
+        # Target folder and file name for the movie
         target_folder = os.path.join(dest_dir_movies, f"{movie_name}")
         print(f"Target folder: {target_folder}")
-        if not os.path.exists(target_folder):
-            os.makedirs(target_folder, exist_ok=True)
-            print(f"Created target folder: {target_folder}")
-
-        # Construct target file name and symlink the largest file
         file_ext = os.path.splitext(largest_file)[1]
         print(f"File extension: {file_ext}")
         target_file_name = f"{movie_name} [{resolution}]{file_ext}"
@@ -532,39 +1320,46 @@ def process_unaccounted_folder(folder_path, dest_dir):
 
         largest_file_path = os.path.join(folder_path, largest_file)
         print(f"Largest file path: {largest_file_path}")
-        if not os.path.exists(target_file_path):
-            try:
-                relative_source_path = os.path.relpath(largest_file_path, os.path.dirname(target_file_path))
-                os.symlink(relative_source_path, target_file_path)
-                print(f"Created relative symlink: {target_file_path} -> {relative_source_path}")
-            except OSError as e:
-                print(f"Error creating relative symlink: {e}")
-        else:
-            print(f"Symlink already exists: {target_file_path}")
-
-        # Insert information into the unaccounted table in the database
-        with db_lock:
-            conn = sqlite3.connect(DATABASE_PATH)
-            c = conn.cursor()
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS unaccounted (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    src_dir TEXT,
-                    file_name TEXT,
-                    matched_imdb_id TEXT,
-                    year TEXT,
-                    symlink_top_folder TEXT,
-                    symlink_filename TEXT
-                )
-            ''')
-            c.execute('''
-                INSERT INTO unaccounted (src_dir, file_name, matched_imdb_id, year, symlink_top_folder, symlink_filename)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (folder_path, largest_file, imdb_id, year, target_folder, target_file_name))
-            conn.commit()
-            conn.close()
+
+        # Record the folder in the unaccounted table once the symlink has been written
+        apply_now = links is None
+        links = links or SymlinkWriter()
+        links.add([(largest_file_path, target_file_path)],
+                  functools.partial(finish_unaccounted_folder, folder_path, largest_file, imdb_id, year,
+                                    target_folder, target_file_name, fingerprint),
+                  info={'unaccounted': folder_path, 'type': 'movie', 'imdb_id': imdb_id})
+        if apply_now:
+            links.apply()
 
     except Exception as e:
         print(f"Error in create_symlinks: {e}")
 
-    return "movie"
\ No newline at end of file
+    return "movie"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Symlink plex_debrid catalog items into a media library.')
+    parser.add_argument('--full-scan', action='store_true', help='Process every unprocessed catalog row, not just new ones.')
+    parser.add_argument('--recall-check', action='store_true', help='Compare blocked matching against brute force and exit.')
+    parser.add_argument('--limit', type=int, help='Only check the first N catalog rows with --recall-check.')
+    parser.add_argument('--dry-run', nargs='?', const='-', metavar='PLAN',
+                        help='Write the link plan as JSON Lines to PLAN (default stdout) instead of linking.')
+    parser.add_argument('--import-catalog', nargs='?', const=CATALOG_PATH, metavar='CSV',
+                        help=f'Import a plex_debrid catalog.csv (default {CATALOG_PATH}) before the pass.')
+    args = parser.parse_args()
+
+    if args.import_catalog:
+        import_catalog(args.import_catalog)
+
+    if args.recall_check:
+        check_blocking_recall(src_dir, limit=args.limit)
+    elif args.dry_run == '-':
+        # Keep the log off stdout so the plan can be piped
+        plan_output = sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            plan_symlinks(plan_output)
+    elif args.dry_run:
+        with open(args.dry_run, 'w') as plan_output:
+            plan_symlinks(plan_output)
+    else:
+        create_symlinks(full_scan=args.full_scan)
@@ -0,0 +1,193 @@
+import argparse
+import os
+import threading
+import time
+from database import ensure_schema, get_connection, migrated_connection
+from pd_symlinker import SRC_DIR, DEST_DIR, catalog_queue, unaccounted_connection
+
+
+RECONCILE_INTERVAL = float(os.getenv('RECONCILE_INTERVAL', '600'))  # seconds between steps, 0 disables
+RECONCILE_BATCH = int(os.getenv('RECONCILE_BATCH', '200'))  # title folders per step
+RECONCILE_PAUSE = float(os.getenv('RECONCILE_PAUSE', '0.05'))  # seconds between title folders
+RECONCILE_NICE = int(os.getenv('RECONCILE_NICE', '10'))
+LIBRARY_FOLDERS = ('movies', 'shows')
+
+
+def _create_reconciler_state(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS reconciler_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+
+
+def read_cursor():
+    ensure_schema('reconciler_state', _create_reconciler_state)
+    row = get_connection().execute("SELECT value FROM reconciler_state WHERE key = 'cursor'").fetchone()
+    return row['value'] if row else ''
+
+
+def write_cursor(cursor):
+    ensure_schema('reconciler_state', _create_reconciler_state)
+    conn = get_connection()
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO reconciler_state (key, value) VALUES ('cursor', ?)", (cursor,))
+
+
+# Removes dangling and stale library links a batch of title folders at a time and requeues their items
+class Reconciler:
+    def __init__(self, src_dir=SRC_DIR, dest_dir=DEST_DIR, batch=RECONCILE_BATCH, pause=RECONCILE_PAUSE):
+        self.src_dir = os.path.abspath(src_dir)
+        self.dest_dir = dest_dir
+        self.batch = batch
+        self.pause = pause
+
+    def source_available(self):
+        try:
+            with os.scandir(self.src_dir) as it:
+                return next(it, None) is not None
+        except OSError:
+            return False
+
+    def title_folders(self):
+        folders = []
+        for library in LIBRARY_FOLDERS:
+            try:
+                with os.scandir(os.path.join(self.dest_dir, library)) as it:
+                    folders.extend(f"{library}/{entry.name}" for entry in it if entry.is_dir(follow_symlinks=False))
+            except FileNotFoundError:
+                continue
+        return sorted(folders)
+
+    def recorded_sources(self, title_folder):
+        # Source folders the catalog and unaccounted records link into this library folder
+        migrated_connection()
+        rows = unaccounted_connection().execute('''
+            SELECT processed_dir_name AS src_dir FROM catalog WHERE final_symlink_path = ?
+            UNION SELECT src_dir FROM unaccounted WHERE symlink_top_folder = ?
+        ''', (title_folder, title_folder)).fetchall()
+        return {row['src_dir'] for row in rows if row['src_dir']}
+
+    # Returns the link's target and 'dangling', 'stale' or None
+    def is_broken(self, link_path, recorded):
+        target = os.path.abspath(os.path.join(os.path.dirname(link_path), os.readlink(link_path)))
+        if not os.path.exists(link_path):
+            return target, 'dangling'
+        # A working link is only stale if it points into the source at a folder the records no longer link here;
+        # links outside the source (another mount path, added by hand) are left alone
+        if (recorded and target.startswith(self.src_dir + os.sep)
+                and not any(target.startswith(src_dir + os.sep) for src_dir in recorded)):
+            return target, 'stale'
+        return target, None
+
+    def check_folder(self, folder, removed, recorded):
+        with os.scandir(folder) as it:
+            entries = list(it)
+        removed_before = len(removed)
+        for entry in entries:
+            if entry.is_symlink():
+                target, problem = self.is_broken(entry.path, recorded)
+                if problem:
+                    print(f"Removing {problem} symlink: {entry.path} -> {target}")
+                    os.unlink(entry.path)
+                    removed.append((entry.path, target, problem))
+            elif entry.is_dir(follow_symlinks=False):
+                self.check_folder(entry.path, removed, recorded)
+        if len(removed) > removed_before:
+            try:
+                os.rmdir(folder)
+                print(f"Removed empty folder: {folder}")
+            except OSError:
+                pass
+
+    def clear_state(self, removed):
+        source_dirs = sorted({os.path.dirname(target) for _, target in removed})
+        link_folders = sorted({os.path.dirname(link) for link, _ in removed})
+        conn = unaccounted_connection()
+        ids = []
+        with conn:
+            for start in range(0, len(source_dirs), 500):
+                chunk = source_dirs[start:start + 500]
+                placeholders = ', '.join('?' for _ in chunk)
+                ids.extend(row['id'] for row in conn.execute(
+                    f'SELECT id FROM catalog WHERE processed_dir_name IN ({placeholders})', chunk))
+                conn.execute(f'DELETE FROM unaccounted WHERE src_dir IN ({placeholders})', chunk)
+                conn.execute(f'DELETE FROM unaccounted_folders WHERE src_dir IN ({placeholders})', chunk)
+            conn.executemany('UPDATE catalog SET processed_dir_name = NULL, final_symlink_path = NULL WHERE id = ?',
+                             [(id,) for id in ids])
+            # Links edited by hand in the UI can point anywhere; match those by where they live
+            conn.executemany('DELETE FROM unaccounted WHERE symlink_top_folder = ? AND symlink_filename = ?',
+                             [os.path.split(link) for link, _ in removed])
+        catalog_queue.enqueue(ids)
+        print(f"Reset {len(ids)} catalog entries linked from {len(source_dirs)} source folders "
+              f"({len(link_folders)} library folders affected)")
+
+    # Returns True once a full sweep has finished
+    def step(self, should_yield=None):
+        if not self.source_available():
+            print(f"Source {self.src_dir} is unavailable or empty; skipping symlink reconciliation")
+            return False
+        cursor = read_cursor()
+        folders = [folder for folder in self.title_folders() if folder > cursor][:self.batch]
+        removed = []
+        interrupted = False
+        for folder in folders:
+            if should_yield is not None and should_yield():
+                interrupted = True
+                break
+            # A mount that drops mid-step would make every remaining link look dangling
+            if not self.source_available():
+                print(f"Source {self.src_dir} became unavailable; stopping symlink reconciliation")
+                interrupted = True
+                break
+            title_folder = os.path.join(self.dest_dir, folder)
+            try:
+                self.check_folder(title_folder, removed, self.recorded_sources(title_folder))
+            except OSError as e:
+                print(f"Error reconciling {folder}: {e}")
+            cursor = folder
+            time.sleep(self.pause)
+        # Stale links have current records elsewhere, so only dangling ones reset state
+        dangling = [(link, target) for link, target, problem in removed if problem == 'dangling']
+        if dangling:
+            self.clear_state(dangling)
+        finished = not interrupted and len(folders) < self.batch
+        write_cursor('' if finished else cursor)
+        if finished:
+            print("Symlink reconciliation finished a sweep of the library")
+        return finished
+
+    def sweep(self):
+        write_cursor('')
+        while self.source_available():
+            if self.step():
+                return True
+        return False
+
+    # should_yield is polled between folders, so symlink passes always go first
+    def run_in_background(self, interval=RECONCILE_INTERVAL, should_yield=None):
+        def loop():
+            try:
+                # On Linux this only lowers the priority of this thread
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), RECONCILE_NICE)
+            except (AttributeError, OSError):
+                pass
+            while True:
+                time.sleep(interval)
+                if should_yield is not None and should_yield():
+                    continue
+                try:
+                    self.step(should_yield)
+                except Exception as e:
+                    print(f"Error in symlink reconciliation: {e}")
+
+        thread = threading.Thread(target=loop, name='symlink-reconciler', daemon=True)
+        thread.start()
+        return thread
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Remove broken library symlinks and requeue their catalog entries.')
+    parser.parse_args()
+    Reconciler().sweep()
@@ -1,16 +1,12 @@
 from flask import Flask, render_template, request, redirect, url_for
-import sqlite3
 import os
+from database import get_connection
 
 app = Flask(__name__)
 
-DATABASE_PATH = '/data/media_database.db'
-
 
 def get_db_connection():
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return get_connection()
 
 
 @app.route('/')
@@ -19,7 +15,6 @@ def index():
     cur = conn.cursor()
     cur.execute('SELECT * FROM unaccounted')
     movies = cur.fetchall()
-    conn.close()
     return render_template('index.html', movies=movies)
 
 
@@ -43,16 +38,14 @@ def edit(id):
         os.symlink(source_file_path, new_symlink_path)
 
         # Update the database with new symlink information
-        conn.execute('''
-            UPDATE unaccounted
-            SET symlink_top_folder = ?, symlink_filename = ?
-            WHERE id = ?
-        ''', (new_symlink_folder, new_symlink_filename, id))
-        conn.commit()
-        conn.close()
+        with conn:
+            conn.execute('''
+                UPDATE unaccounted
+                SET symlink_top_folder = ?, symlink_filename = ?
+                WHERE id = ?
+            ''', (new_symlink_folder, new_symlink_filename, id))
         return redirect(url_for('index'))
 
-    conn.close()
     return render_template('edit.html', movie=movie)
 
 